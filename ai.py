@@ -1,14 +1,79 @@
-from pieces import Kind, Piece
-from board import Board
+import multiprocessing
+import queue
+import random
+import time
+from collections import OrderedDict
+from multiprocessing import shared_memory
+
+from pieces import BENT_RIDERS, Kind, Piece
+from board import Board, PACKED_SIZE, PAWN_KINDS, PAWN_ZOBRIST
+from tablebase import Tablebases, MAX_PIECES as TABLEBASE_PIECES
 from util import *
-from random import choice as random_pick
 
 MEMORY_FILE_NAME = "ai_memory.board"
 DEPTH = 3  # THIS SHOULD BE AN ODD NUMBER
+DEPTH_LIMIT = 64  # Iterative deepening of the in-game AI ends here if time remains.
+THINK_TIME = 2  # Seconds the in-game AI searches for a move.
 
 SPACE_VALUE = 1/128
 PROMOTION_VALUE = 5
 
+# SCORES ARE PACKED INTO ONE INTEGER: MATE ABOVE MATERIAL ABOVE THREATS ABOVE POSITIONAL TERMS
+POSITIONAL_ONE = 2**15  # Fixed point unit of the positional term, exact for the 2**-k nearness terms.
+THREAT_ONE = 2**30  # Leaves room for positional terms up to 2**14 in either direction.
+MATERIAL_ONE = 2**45  # Leaves room for threats up to 2**14 in either direction.
+MATE_SCORE = 2**60  # Minus the plies to mate, above any material up to 2**14.
+MAX_MATE_PLIES = 1024
+MATE_BOUND = MATE_SCORE - MAX_MATE_PLIES
+SPACE_UNIT = int(SPACE_VALUE * POSITIONAL_ONE)
+
+TABLE_SIZE = 2**18  # Maximum number of transposition table entries.
+PAWN_TABLE_SIZE = 2**14  # Maximum number of cached pawn structure scores.
+EXACT, LOWER, UPPER = 0, 1, 2
+INFINITY = MATE_SCORE + 1  # Above every score.
+NEGATIVE_INFINITY = -INFINITY
+
+_zobrist_random = random.Random(5398)
+ZOBRIST = {(side, kind): [_zobrist_random.getrandbits(64) for _ in range(BOARD_SIZE ** 2)] for side in (1, 2) for kind in Kind}
+ZOBRIST_TURN = _zobrist_random.getrandbits(64)
+ZOBRIST_EN_PASSANT = [_zobrist_random.getrandbits(64) for _ in range(BOARD_SIZE ** 2)]
+
+
+# REVERSED ATTACK PATTERNS: A PIECE OF ONE OF THE KINDS ON A FOUND SQUARE ATTACKS THE ORIGIN
+ATTACK_PATTERNS = [
+	("ray", DIRS_ROOK, -1, {Kind.ROOK, Kind.QUEEN, Kind.DRAGONWOMAN, Kind.UNICORN}),
+	("ray", DIRS_BISHOP, -1, {Kind.BISHOP, Kind.QUEEN, Kind.DIABLO, Kind.UNICORN}),
+	("ray", DIRS_QUEEN, 1, {Kind.KING, Kind.BUFFOON, Kind.LION}),
+	("ray", DIRS_BISHOP, 1, {Kind.ELEPHANT}),
+	("ray", DIRS_ROOK, 1, {Kind.MACHINE}),
+	("knights_move", (2, 1), None, {Kind.KNIGHT, Kind.DRAGONWOMAN, Kind.DIABLO, Kind.UNICORN, Kind.BUFFALO, Kind.LION}),
+	("knights_move", (2, 2), None, {Kind.ELEPHANT, Kind.ANTELOPE, Kind.LION}),
+	("knights_move", (2, 0), None, {Kind.MACHINE, Kind.ANTELOPE, Kind.LION}),
+	("knights_move", (3, 1), None, {Kind.CAMEL, Kind.BUFFALO}),
+	("knights_move", (3, 2), None, {Kind.BULL, Kind.BUFFALO}),
+	("knights_move", (3, 3), None, {Kind.ANTELOPE}),
+	("knights_move", (3, 0), None, {Kind.ANTELOPE}),
+	("artillery", DIRS_ROOK, None, {Kind.CANNON, Kind.STAR}),
+	("artillery", DIRS_BISHOP, None, {Kind.BOW, Kind.STAR}),
+]
+
+# SELECTIVE SEARCH, EACH CAN BE SWITCHED OFF PER BOARD TO MEASURE ITS EFFECT
+SEE_PRUNING = True  # Skip captures that lose material one ply before the leaves.
+NULL_MOVE_PRUNING = True
+NULL_MOVE_REDUCTION = 2
+NULL_MOVE_MATERIAL = 40  # Below this worth, zugzwang is too likely to pass the turn.
+LATE_MOVE_REDUCTIONS = True
+LATE_MOVE_INDEX = 6  # Quiet moves from this index on are searched one ply shallower first.
+FUTILITY_PRUNING = True
+FUTILITY_MARGIN = 3  # In units of material.
+
+TABLEBASES = Tablebases()
+
+
+class SearchStopped(Exception):
+	pass
+
+
 class Reversal():
 	def __init__(self, board, squares):
 		
@@ -26,14 +91,46 @@ class Reversal():
 			self.changes[sq] = (piece.side, piece.kind)
 
 
+class PawnTable():
+	# PAWN STRUCTURE SCORES BY PAWN KEY, DROPPING THE LEAST RECENTLY USED WHEN FULL
+	def __init__(self, size=PAWN_TABLE_SIZE):
+		self.size = size
+		self.entries = OrderedDict()
+	
+	def get(self, key):
+		score = self.entries.get(key)
+		if score is not None:
+			self.entries.move_to_end(key)
+		return score
+	
+	def store(self, key, score):
+		self.entries[key] = score
+		if len(self.entries) > self.size:
+			self.entries.popitem(last=False)
+	
+	def clear(self):
+		self.entries.clear()
+
+
 class AiMemoryBoard(Board):
 	
 	def __init__(self, turn):
 		Board.__init__(self, turn)
 		self.stack_of_reversals = []
+		self.should_stop = None
 		
 		self.side_1_pieces = set()
 		self.side_2_pieces = set()
+		
+		self.hash = 0
+		self.table = dict()
+		self.pawn_table = PawnTable()
+		self.nodes = 0
+		
+		self.see_pruning = SEE_PRUNING
+		self.null_move_pruning = NULL_MOVE_PRUNING
+		self.late_move_reductions = LATE_MOVE_REDUCTIONS
+		self.futility_pruning = FUTILITY_PRUNING
 	
 	def clear(self):
 		Board.clear(self)
@@ -41,6 +138,7 @@ class AiMemoryBoard(Board):
 		
 		self.side_1_pieces = set()
 		self.side_2_pieces = set()
+		self.hash = 0
 	
 	def get_setup_from_board(self, board):
 		
@@ -48,13 +146,7 @@ class AiMemoryBoard(Board):
 			piece = board.squares[sq]
 			
 			if piece is not None:
-				new_piece = Piece(piece.side, piece.kind, sq)
-				self.squares[sq] = new_piece
-				
-				if new_piece.side == 1:
-					self.side_1_pieces.add(sq)
-				else:
-					self.side_2_pieces.add(sq)
+				self.create_piece(piece.side, piece.kind, sq)
 		
 		self.turn = board.turn
 		self.en_passant = board.en_passant
@@ -72,6 +164,9 @@ class AiMemoryBoard(Board):
 				self.side_2_worth -= WORTHS[piece.kind.value]
 				self.side_2_pieces.remove(sq)
 			
+			self.hash ^= ZOBRIST[piece.side, piece.kind][sq]
+			if piece.kind in PAWN_KINDS:
+				self.pawn_key ^= PAWN_ZOBRIST[piece.side, piece.kind][sq]
 			self.squares[sq] = None
 		
 	def create_piece(self, side, kind, square=0, xy=None):
@@ -79,6 +174,9 @@ class AiMemoryBoard(Board):
 		self.remove_piece(sq)
 		
 		self.squares[sq] = Piece(side, kind, sq)
+		self.hash ^= ZOBRIST[side, kind][sq]
+		if kind in PAWN_KINDS:
+			self.pawn_key ^= PAWN_ZOBRIST[side, kind][sq]
 		
 		if side == 1:
 			self.side_1_worth += WORTHS[kind.value]
@@ -92,6 +190,9 @@ class AiMemoryBoard(Board):
 		self.remove_piece(sq)
 		
 		self.squares[sq] = piece
+		self.hash ^= ZOBRIST[piece.side, piece.kind][sq]
+		if piece.kind in PAWN_KINDS:
+			self.pawn_key ^= PAWN_ZOBRIST[piece.side, piece.kind][sq]
 		
 		if piece.side == 1:
 			self.side_1_worth += WORTHS[piece.kind.value]
@@ -99,12 +200,42 @@ class AiMemoryBoard(Board):
 		else:
 			self.side_2_worth += WORTHS[piece.kind.value]
 			self.side_2_pieces.add(sq)
+			
+	def change_piece_kind(self, sq, new_kind):
+		piece = self.squares[sq]
+		if piece is not None:
+			self.hash ^= ZOBRIST[piece.side, piece.kind][sq] ^ ZOBRIST[piece.side, new_kind][sq]
+		Board.change_piece_kind(self, sq, new_kind)
+		
+	def pawn_structure(self):
+		# ONLY DEPENDS ON WHERE THE PAWNS AND CENTURIONS ARE, SO IT IS CACHED BY THE PAWN KEY
+		score = self.pawn_table.get(self.pawn_key)
+		if score is not None:
+			return score
+		
+		score = 0
+		for sq in self.side_1_pieces | self.side_2_pieces:
+			piece = self.squares[sq]
+			if piece.kind in PAWN_KINDS:
+				if piece.side == 1:
+					score += POSITIONAL_ONE >> (BOARD_SIZE - 1 - piece.y)
+				else:
+					score -= POSITIONAL_ONE >> piece.y
+		
+		self.pawn_table.store(self.pawn_key, score)
+		return score
+		
+	def key(self):
+		key = self.hash ^ (ZOBRIST_TURN if self.turn == 2 else 0)
+		if self.en_passant[0] >= 0:
+			key ^= ZOBRIST_EN_PASSANT[self.en_passant[0]]
+		return key
 		
 	def reset(self):
 		while self.stack_of_reversals:
 			self.revert()
 		
-	def move(self, from_sq, to_sq, promote_idx=0):
+	def move(self, from_sq, to_sq, promotion=None):
 		reversal = Reversal(self, {from_sq, to_sq})
 		piece = self.squares[from_sq]
 		
@@ -125,12 +256,16 @@ class AiMemoryBoard(Board):
 			self.en_passant = (-1, -1)
 
 		if to_sq in piece.promotion_squares():
-			options = piece.promotion_pieces()
-			self.change_piece_kind(piece.square, options[promote_idx])
+			self.change_piece_kind(piece.square, promotion or piece.promotion_pieces()[0])
 
 		self.turn = 3 - self.turn
 		self.stack_of_reversals.append(reversal)
 		
+	def pass_turn(self):
+		self.stack_of_reversals.append(Reversal(self, set()))
+		self.en_passant = (-1, -1)
+		self.turn = 3 - self.turn
+		
 	def revert(self):
 		reversal = self.stack_of_reversals.pop()
 		self.en_passant = reversal.en_passant
@@ -145,31 +280,179 @@ class AiMemoryBoard(Board):
 				
 		self.turn = 3 - self.turn
 				
-	def evaluate(self):
+	def attackers(self, sq, side):
+		other_side = 3 - side
+		found = set()
+		
+		for pattern, argument, max_length, kinds in ATTACK_PATTERNS:
+			if pattern == "ray":
+				_, captures = self.ray(other_side, sq, argument, max_length=max_length, mode=CAPTURES)
+			elif pattern == "knights_move":
+				_, captures = self.knights_move(other_side, sq, ab=argument, mode=CAPTURES)
+			else:
+				_, captures = self.artillery(other_side, sq, argument, mode=CAPTURES)
+			found.update(cap for cap in captures if self.squares[cap].kind in kinds)
+		
+		pawn_dirs = [DIR_SOUTHEAST, DIR_SOUTHWEST] if side == 1 else [DIR_NORTHEAST, DIR_NORTHWEST]
+		_, captures = self.ray(other_side, sq, pawn_dirs, max_length=1, mode=CAPTURES)
+		found.update(cap for cap in captures if self.squares[cap].kind in (Kind.PAWN, Kind.CENTURION))
+		
+		for from_sq in (self.side_1_pieces if side == 1 else self.side_2_pieces):
+			piece = self.squares[from_sq]
+			# THEIR PATHS ARE NOT SYMMETRIC, SO THEY ARE TESTED DIRECTLY
+			if piece.kind in BENT_RIDERS and sq in piece.move_and_capture_squares(self, check_check=False, mode=CAPTURES)[1]:
+				found.add(from_sq)
+		
+		return found
+		
+	def king_square(self, side):
+		for sq in (self.side_1_pieces if side == 1 else self.side_2_pieces):
+			if self.squares[sq].kind == Kind.KING:
+				return sq
+		return None
+		
+	def king_attacked(self, side):
+		return bool(self.checkers(side))
+		
+	def checkers(self, side=0):
+		if side == 0:
+			side = self.turn
+		king = self.king_square(side)
+		if king is None:
+			return []
+		return list(self.attackers(king, 3 - side))
+		
+	def has_legal_move(self):
+		# STOPS AT THE FIRST LEGAL MOVE INSTEAD OF COPYING THE BOARD FOR EVERY CANDIDATE
+		side = self.turn
+		for sq in list(self.side_1_pieces if side == 1 else self.side_2_pieces):
+			moves, captures = self.squares[sq].move_and_capture_squares(self, check_check=False)
+			for to_sq in captures | moves:
+				self.move(sq, to_sq)
+				legal = not self.king_attacked(side)
+				self.revert()
+				if legal:
+					return True
+		return False
+		
+	def least_valuable_attacker(self, sq, side):
+		attackers = self.attackers(sq, side)
+		king = None
+		best = None
+		for from_sq in attackers:
+			kind = self.squares[from_sq].kind
+			if kind == Kind.KING:
+				king = from_sq
+			elif best is None or (WORTHS[kind.value], from_sq) < (WORTHS[self.squares[best].kind.value], best):
+				best = from_sq
+		
+		# THE KING ONLY CAPTURES LAST, ONTO A SQUARE THE OPPONENT NO LONGER ATTACKS
+		if best is None and king is not None and not self.attackers(sq, 3 - side):
+			return king
+		return best
+		
+	def static_exchange(self, sq, side=None):
 		"""
-		Outputs a tuple of numbers (a, b, c).
+		Material that side wins by capturing on sq, after which both sides recapture with
+		their least valuable attacker for as long as it pays. Captures are really made, so
+		pieces behind the capturers and screens of the Cannon, Bow and Star are accounted for.
+		"""
+		
+		if side is None:
+			side = self.turn
+		target = self.squares[sq]
+		if target is None or target.side == side:
+			return 0
+		
+		values = [WORTHS[target.kind.value]]
+		captures = 0
+		while True:
+			from_sq = self.least_valuable_attacker(sq, side)
+			if from_sq is None:
+				break
+			self.move(from_sq, sq)
+			captures += 1
+			values.append(WORTHS[self.squares[sq].kind.value])
+			side = 3 - side
+		
+		for _ in range(captures):
+			self.revert()
+		
+		if captures == 0:
+			return 0
+		
+		# EVERY CAPTURE AFTER THE FIRST IS OPTIONAL
+		score = 0
+		for i in reversed(range(1, captures)):
+			score = max(0, values[i] - score)
+		return values[0] - score
+		
+	def evaluate(self, alpha=NEGATIVE_INFINITY, beta=INFINITY, mobility=True):
+		"""
+		Outputs a packed score (see pack_score) built from
 		a = Checkmate.
 		b = Value of pieces.
 		c = Attacks on enemy pieces.
 		d = Negative value of undefended pieces.
 		e = Nearness of promoting pieces to their promotion squares.
 		f = Scope.
+		
+		The terms are computed in stages from cheap to expensive. As soon as the remaining
+		stages cannot lift the score above alpha or push it below beta, a bound is
+		returned instead, which is at most alpha or at least beta.
+		Without mobility, f is left at 0.
 		"""
 		
+		# SMALL ENDINGS ARE LOOKED UP INSTEAD
+		if len(self.side_1_pieces) + len(self.side_2_pieces) <= TABLEBASE_PIECES:
+			result = TABLEBASES.probe(self)
+			if result is not None:
+				return self.tablebase_score(result)
+		
 		# CHECKMATE ECLIPSES ALL
-		if self.check_mate():
+		if not self.has_legal_move():
 			if self.turn == 1:
-				return (-1, 0, 0, 0, 0, 0)
+				return -MATE_SCORE
 			else:
-				return (1, 0, 0, 0, 0, 0)
-				
+				return MATE_SCORE
+		
 		turn_player_pieces = self.side_1_pieces if self.turn == 1 else self.side_2_pieces
 		other_player_pieces = self.side_2_pieces if self.turn == 1 else self.side_1_pieces
 		
-		# CREATE DATA ABOUT MOVES, CAPTURES AND DEFENDED SQUARES
+		# STAGE 1: MATERIAL
+		# THE TURN PLAYER CAN ONLY GAIN MATERIAL FROM THREATS, AND ONLY LOSE ATTACK SCORE
+		score_b = self.side_1_worth - self.side_2_worth
+		if self.turn == 1:
+			lower = score_range(score_b)[0]
+			upper = score_range(score_b + self.side_2_worth, 0)[1]
+		else:
+			lower = score_range(score_b - self.side_1_worth, 0)[0]
+			upper = score_range(score_b)[1]
+		if upper <= alpha:
+			return upper
+		if lower >= beta:
+			return lower
+		
+		# STAGE 2: NEARNESS OF PIECES TO THEIR PROMOTION SQUARES
+		score_e = self.pawn_structure()
+		for sq in self.side_1_pieces | self.side_2_pieces:
+			piece = self.squares[sq]
+			
+			if piece.kind == Kind.BUFFOON:
+				if piece.side == 1:
+					score_e += POSITIONAL_ONE >> abs((BOARD_SIZE // 2) - piece.y)
+				else:
+					score_e -= POSITIONAL_ONE >> abs(piece.y - (BOARD_SIZE // 2 - 1))
+
+			elif piece.kind == Kind.SHIP:
+				if piece.side == 1:
+					score_e += POSITIONAL_ONE >> min(abs(piece.x - 1), abs(piece.x - (BOARD_SIZE - 2)))
+				else:
+					score_e -= POSITIONAL_ONE >> min(abs(piece.x - 1), abs(piece.x - (BOARD_SIZE - 2)))
+		
+		# STAGE 3: THREATS
 		possible_moves = dict()
-		possible_captures = dict()
-		cheapest_attackers = dict()
+		attacked_squares = set()
 		defended_pieces = set()
 		
 		for sq in self.side_1_pieces | self.side_2_pieces:
@@ -178,35 +461,21 @@ class AiMemoryBoard(Board):
 			defenses = piece.defended_pieces(self)
 			
 			possible_moves[sq] = moves
-			for to_sq in captures:
-				if to_sq not in cheapest_attackers:
-					cheapest_attackers[to_sq] = WORTHS[piece.kind.value]
-				else:
-					cheapest_attackers[to_sq] = min(cheapest_attackers[to_sq], WORTHS[piece.kind.value])
+			attacked_squares |= captures
 			defended_pieces = defended_pieces | defenses
 		
-		# INITIALIZE SCORE
-		score_b = self.side_1_worth - self.side_2_worth
 		score_c = 0
 		score_d = 0
-		score_e = 0
-		score_f = 0
 		
 		# HANDLE TURN PLAYER UNDEFENDED PIECES
 		turn_player_weaknesses = []
 		
-		for sq in turn_player_pieces:
-			piece = self.squares[sq]
-			worth = WORTHS[piece.kind.value]
-			defended = sq in defended_pieces
-			attacked = sq in cheapest_attackers
-			
-			if attacked and defended:
-				if worth > cheapest_attackers[sq]:
-					turn_player_weaknesses.append(worth - cheapest_attackers[sq])
-			
-			elif attacked and not defended:
-				turn_player_weaknesses.append(worth)
+		# STATIC EXCHANGES MOVE PIECES IN AND OUT OF THE SETS, SO THEY ARE COPIED
+		for sq in list(turn_player_pieces):
+			if sq in attacked_squares:
+				exchange = self.static_exchange(sq, 3 - self.turn)
+				if exchange > 0:
+					turn_player_weaknesses.append(exchange)
 		
 		if turn_player_weaknesses:
 			turn_player_weaknesses.remove(max(turn_player_weaknesses))
@@ -215,18 +484,16 @@ class AiMemoryBoard(Board):
 		other_player_weaknesses = []
 		other_player_undefended = []
 		
-		for sq in other_player_pieces:
+		for sq in list(other_player_pieces):
 			piece = self.squares[sq]
 			worth = WORTHS[piece.kind.value]
 			defended = sq in defended_pieces
-			attacked = sq in cheapest_attackers
-			
-			if attacked and defended:
-				if worth > cheapest_attackers[sq]:
-					other_player_weaknesses.append(worth - cheapest_attackers[sq])
+			attacked = sq in attacked_squares
 			
-			elif attacked and not defended:
-				other_player_weaknesses.append(worth)
+			if attacked:
+				exchange = self.static_exchange(sq, self.turn)
+				if exchange > 0:
+					other_player_weaknesses.append(exchange)
 			
 			elif piece.side == 1 and sq >= 2 * BOARD_SIZE: 	
 				if not attacked and not defended:
@@ -246,29 +513,17 @@ class AiMemoryBoard(Board):
 			score_c += sum(turn_player_weaknesses)
 			score_d -= sum(other_player_undefended)
 		
-		# ADD NEARNESS OF PIECES TO THEIR PROMOTION SQUARES
-		for sq in self.side_1_pieces | self.side_2_pieces:
-			piece = self.squares[sq]
-			
-			if piece.kind in [Kind.PAWN, Kind.CENTURION]:
-				if piece.side == 1:
-					score_e += 2**-(BOARD_SIZE - 1 - piece.y)
-				else:
-					score_e -= 2**-piece.y
-
-			elif piece.kind == Kind.BUFFOON:
-				if piece.side == 1:
-					score_e += 2**-abs((BOARD_SIZE // 2) - piece.y)
-				else:
-					score_e -= 2**-abs(piece.y - (BOARD_SIZE // 2 - 1))
-
-			elif piece.kind == Kind.SHIP:
-				if piece.side == 1:
-					score_e += 2**-min(abs(piece.x - 1), abs(piece.x - (BOARD_SIZE - 2)))
-				else:
-					score_e -= 2**-min(abs(piece.x - 1), abs(piece.x - (BOARD_SIZE - 2)))
+		# SCOPE ONLY BREAKS TIES BETWEEN EQUAL MATERIAL AND ATTACKS
+		if not mobility:
+			return pack_score(score_b, score_c, score_d * POSITIONAL_ONE + PROMOTION_VALUE * score_e)
+		lower, upper = score_range(score_b, score_c)
+		if upper <= alpha:
+			return upper
+		if lower >= beta:
+			return lower
 		
-		# ADD SCORE FOR SPACE
+		# STAGE 4: MOBILITY
+		score_f = 0
 		for sq in self.side_1_pieces:
 			if self.squares[sq].kind not in (Kind.BOW, Kind.CANNON, Kind.STAR, Kind.KING):
 				score_f += len(possible_moves[sq])
@@ -277,53 +532,359 @@ class AiMemoryBoard(Board):
 			if self.squares[sq].kind not in (Kind.BOW, Kind.CANNON, Kind.STAR, Kind.KING):
 				score_f -= len(possible_moves[sq])
 			
-		return (0, score_b, score_c, score_d, score_e, score_f)
+		return pack_score(score_b, score_c, score_d * POSITIONAL_ONE + PROMOTION_VALUE * score_e + SPACE_UNIT * score_f)
 		
-	def find_best_move(self):
-		all_moves = set()
-		all_captures = set()
+	def tablebase_score(self, result):
+		outcome, plies = result
+		if outcome == 0:
+			return 0
 		
-		scores = dict()
+		winner = self.turn if outcome > 0 else 3 - self.turn
+		return mate_score(winner, plies)
+	
+	def tablebase_move(self):
+		if len(self.side_1_pieces) + len(self.side_2_pieces) > TABLEBASE_PIECES or TABLEBASES.probe(self) is None:
+			return None
+		
+		scored = []
+		for move in self.legal_moves():
+			self.move(*move)
+			scored.append((self.evaluate(), move))
+			self.revert()
 		
-		# MAKE SETS WITH MOVES AND CAPTURES
+		if not scored:
+			return None
+		# MOVES WITH A PROMOTION KIND DO NOT ORDER, SO ONLY THE SCORES ARE COMPARED
+		best = (max if self.turn == 1 else min)(scored, key=lambda result: result[0])
+		return best[1]
+	
+	def promotion_moves(self, from_sq, to_sq):
+		# A CHOICE OF PROMOTION GIVES ONE MOVE PER KIND, WHICH IS CARRIED AS A THIRD ELEMENT
+		piece = self.squares[from_sq]
+		options = piece.promotion_pieces()
+		if len(options) > 1 and to_sq in piece.promotion_squares():
+			return [(from_sq, to_sq, kind) for kind in options]
+		return [(from_sq, to_sq)]
+		
+	def legal_moves(self, prune_losing=False):
+		moves = []
+		captures = []
 		turn_player_pieces = self.side_1_pieces if self.turn == 1 else self.side_2_pieces
 		
-		for sq in turn_player_pieces:
-			moves, captures = self.possible_moves(sq)
-			for to_sq in moves:
-				all_moves.add((sq, to_sq))
-			for to_sq in captures:
-				all_captures.add((sq, to_sq))
-		
-		# EVALUATE MOVES
-		for sq, to_sq in all_moves | all_captures:
-			self.move(sq, to_sq)
-			score = self.evaluate()
-			scores[(sq, to_sq)] = score
-			print(to_coords(sq), "->", to_coords(to_sq) ,":", score)
-			self.revert()
-
-		# CHOOSE A RANDOM HIGHEST SCORING MOVE
-		if self.turn == 1:
-			best_score = max(scores.values(), key=score_sort_key)
+		checkers = self.checkers()
+		if checkers:
+			# IN CHECK, ONLY THE EVASION CANDIDATES ARE TRIED
+			side = self.turn
+			for from_sq, to_sq, capture in self.evasion_candidates(side, checkers):
+				self.move(from_sq, to_sq)
+				legal = not self.king_attacked(side)
+				self.revert()
+				if legal:
+					(captures if capture else moves).extend(self.promotion_moves(from_sq, to_sq))
 		else:
-			best_score = min(scores.values(), key=score_sort_key)
-		best_move = random_pick(tuple(key for key in scores if scores[key] == best_score))
+			for sq in turn_player_pieces:
+				to_moves, to_captures = self.possible_moves(sq)
+				for to_sq in to_moves:
+					moves.extend(self.promotion_moves(sq, to_sq))
+				for to_sq in to_captures:
+					captures.extend(self.promotion_moves(sq, to_sq))
+		
+		# WINNING AND EVEN CAPTURES FIRST, LOSING CAPTURES LAST
+		exchanges = dict()
+		for move in captures:
+			to_sq = move[1]
+			if self.squares[to_sq] is None:  # En passant.
+				exchanges[move] = 0
+				continue
+			victim = WORTHS[self.squares[to_sq].kind.value]
+			self.move(*move)
+			exchanges[move] = victim - self.exchange_after_capture(to_sq)
+			self.revert()
+		
+		captures.sort(key=lambda move: -exchanges[move])
+		good_captures = [move for move in captures if exchanges[move] >= 0]
+		bad_captures = [move for move in captures if exchanges[move] < 0]
+		
+		if prune_losing and (good_captures or moves):
+			return good_captures + moves
+		return good_captures + moves + bad_captures
+		
+	def exchange_after_capture(self, sq):
+		# WHAT THE OPPONENT GAINS BY RECAPTURING ON SQ, IF IT PAYS AT ALL
+		return max(0, self.static_exchange(sq, self.turn))
+		
+	def store(self, key, entry):
+		if len(self.table) >= TABLE_SIZE:
+			self.table.clear()
+		self.table[key] = entry
+		
+	def is_quiet(self, from_sq, to_sq, promotion=None):
+		if self.squares[to_sq] is not None or to_sq == self.en_passant[0]:
+			return False
+		return to_sq not in self.squares[from_sq].promotion_squares()
+		
+	def search(self, depth, alpha, beta, null_allowed=True):
+		"""
+		Alpha-beta search in which side 1 maximizes and side 2 minimizes packed scores.
+		Mate scores are relative to the searched position, so they are stepped through each ply.
+		"""
 		
-		print("--- Decided on", to_coords(best_move[0]), "->", to_coords(best_move[1]) ,":", best_score, "---")
-		return best_move
+		self.nodes += 1
+		if self.should_stop is not None and self.should_stop():
+			raise SearchStopped()
+		
+		key = self.key()
+		entry = self.table.get(key)
+		best_move = None
+		if entry is not None:
+			entry_depth, value, bound, best_move = entry
+			if entry_depth >= depth:
+				if bound == EXACT or (bound == LOWER and value >= beta) or (bound == UPPER and value <= alpha):
+					return value
+		
+		if depth == 0:
+			value = self.evaluate(alpha, beta)
+			bound = UPPER if value <= alpha else LOWER if value >= beta else EXACT
+			self.store(key, (0, value, bound, None))
+			return value
+		
+		maximizing = self.turn == 1
+		selective = self.null_move_pruning or self.late_move_reductions or self.futility_pruning
+		in_check = selective and self.king_attacked(self.turn)
+		
+		# NULL MOVE: IF PASSING STILL FAILS HIGH, A REAL MOVE WILL TOO
+		worth = self.side_1_worth if maximizing else self.side_2_worth
+		if self.null_move_pruning and null_allowed and not in_check and depth > NULL_MOVE_REDUCTION and worth >= NULL_MOVE_MATERIAL:
+			self.pass_turn()
+			value = self.search_child(depth - 1 - NULL_MOVE_REDUCTION, alpha, beta, null_allowed=False)
+			self.revert()
+			if (maximizing and value >= beta) or (not maximizing and value <= alpha):
+				return value
+		
+		moves = self.legal_moves(prune_losing=self.see_pruning and depth == 1)
+		if not moves:
+			value = self.evaluate()
+			self.store(key, (depth, value, EXACT, None))
+			return value
+		
+		if best_move in moves:
+			moves.remove(best_move)
+			moves.insert(0, best_move)
+		
+		# FUTILITY: ONE PLY BEFORE THE LEAVES, QUIET MOVES CANNOT MAKE UP A LARGE MATERIAL DEFICIT
+		static = None
+		if self.futility_pruning and depth == 1 and not in_check:
+			static = self.evaluate(mobility=False)
+			if is_mate(static):
+				static = None
+		
+		best = None
+		low, high = alpha, beta
+		
+		for i, move in enumerate(moves):
+			quiet = selective and self.is_quiet(*move)
+			
+			if static is not None and quiet:
+				if maximizing and material(low) >= material(static) + FUTILITY_MARGIN:
+					continue
+				if not maximizing and material(high) <= material(static) - FUTILITY_MARGIN:
+					continue
+			
+			self.move(*move)
+			if self.late_move_reductions and quiet and i >= LATE_MOVE_INDEX and depth >= 3 and not in_check:
+				value = self.search_child(depth - 2, low, high)
+				if value > low if maximizing else value < high:
+					value = self.search_child(depth - 1, low, high)
+			else:
+				value = self.search_child(depth - 1, low, high)
+			self.revert()
+			
+			if best is None or (value > best if maximizing else value < best):
+				best = value
+				best_move = move
+			
+			if maximizing:
+				low = max(low, value)
+			else:
+				high = min(high, value)
+			if low >= high:
+				break
+		
+		# EVERY MOVE WAS FUTILE
+		if best is None:
+			best = static
+			best_move = None
+		
+		bound = UPPER if best <= alpha else LOWER if best >= beta else EXACT
+		self.store(key, (depth, best, bound, best_move))
+		return best
+		
+	def search_child(self, depth, alpha, beta, null_allowed=True):
+		# SEARCHES THE POSITION AFTER A MOVE, WITH MATES ONE PLY FURTHER AWAY FROM HERE
+		value = self.search(depth, mate_to_child(alpha), mate_to_child(beta), null_allowed)
+		return mate_from_child(value)
+		
+	def principal_variation(self, depth):
+		line = []
+		for _ in range(depth):
+			entry = self.table.get(self.key())
+			if entry is None or entry[3] is None:
+				break
+			move = entry[3]
+			if move not in self.legal_moves():
+				break
+			line.append(move)
+			self.move(*move)
+		
+		for _ in line:
+			self.revert()
+		return line
+		
+	def think(self, max_depth=DEPTH, multipv=1, report=None):
+		"""
+		Iterative deepening over the root moves.
+		Returns the list of (score, move) for the last completed depth, best first.
+		Only the first multipv scores are exact, the others are bounds from a narrowed window.
+		report(depth, results) is called after each completed depth.
+		"""
+		
+		self.nodes = 0
+		maximizing = self.turn == 1
+		moves = self.legal_moves()
+		results = []
+		scored = []
+		
+		try:
+			for depth in range(1, max_depth + 1):
+				scored = []
+				for move in moves:
+					# FULL WINDOW FOR THE MULTI-PV LINES, ONLY BETTER MOVES MATTER AFTERWARDS
+					if len(scored) < multipv:
+						alpha, beta = NEGATIVE_INFINITY, INFINITY
+					else:
+						threshold = sorted((value for value, _ in scored), reverse=maximizing)[multipv - 1]
+						alpha, beta = (threshold, INFINITY) if maximizing else (NEGATIVE_INFINITY, threshold)
+					
+					self.move(*move)
+					value = self.search_child(depth - 1, alpha, beta)
+					self.revert()
+					scored.append((value, move))
+				
+				scored.sort(key=lambda result: result[0], reverse=maximizing)
+				results = scored
+				moves = [move for _, move in scored]
+				if report is not None:
+					report(depth, results)
+		except SearchStopped:
+			self.reset()
+			
+			# STOPPED DURING THE FIRST DEPTH, FALL BACK TO THE MOVES SEARCHED SO FAR
+			if not results:
+				results = sorted(scored, key=lambda result: result[0], reverse=maximizing)
+		
+		return results
 
-def score_sort_key(score):
-	a, b, c, d, e, f = score
-	return (a, b, c, d + PROMOTION_VALUE * e + SPACE_VALUE * f)
+def pack_score(material=0, threats=0, positional=0):
+	# POSITIONAL IS IN UNITS OF 1 / POSITIONAL_ONE
+	return material * MATERIAL_ONE + threats * THREAT_ONE + positional
 
-def get_ai_move(board):
-	turn = board.turn
-	
-	memory_board = AiMemoryBoard(turn)
+def score_range(material, threats=None):
+	# LOWEST AND HIGHEST SCORES WITH THESE LEADING TERMS
+	if threats is None:
+		base, half = material * MATERIAL_ONE, MATERIAL_ONE // 2
+	else:
+		base, half = material * MATERIAL_ONE + threats * THREAT_ONE, THREAT_ONE // 2
+	return base - half + 1, base + half - 1
+
+def mate_score(winner, plies=0):
+	return MATE_SCORE - plies if winner == 1 else plies - MATE_SCORE
+
+def is_mate(score):
+	return abs(score) > MATE_BOUND
+
+def material(score):
+	# ROUNDS TO THE NEAREST MATERIAL, SO MATES AND INFINITIES STAY ABOVE AND BELOW ALL OTHERS
+	return (score + MATERIAL_ONE // 2) // MATERIAL_ONE
+
+def mate_from_child(score):
+	if MATE_BOUND < score <= MATE_SCORE:
+		return score - 1
+	if -MATE_SCORE <= score < -MATE_BOUND:
+		return score + 1
+	return score
+
+def mate_to_child(score):
+	# INVERSE OF mate_from_child FOR THE SEARCH WINDOW
+	if MATE_BOUND <= score < MATE_SCORE:
+		return score + 1
+	if -MATE_SCORE < score <= -MATE_BOUND:
+		return score - 1
+	return score
+
+def mate_plies(score):
+	return MATE_SCORE - abs(score)
+
+def score_terms(score):
+	"""
+	Unpacks a score for display into (mate, material, threats, positional),
+	where mate is 1 or -1 for the mating side and the other terms are 0 then.
+	"""
+	if is_mate(score):
+		return (1 if score > 0 else -1), 0, 0, 0
+	b = material(score)
+	rest = score - b * MATERIAL_ONE
+	c = (rest + THREAT_ONE // 2) // THREAT_ONE
+	return 0, b, c, (rest - c * THREAT_ONE) / POSITIONAL_ONE
+
+def score_text(score):
+	mate, b, c, positional = score_terms(score)
+	if mate:
+		return f"side {1 if mate > 0 else 2} mates in {mate_plies(score)} plies"
+	return f"material {b}, threats {c}, positional {positional:g}"
+
+def get_ai_move(board, should_stop=None, progress=None, seconds=THINK_TIME, max_depth=DEPTH_LIMIT):
+	"""
+	Searches the board by iterative deepening until the time is up or max_depth is completed, and returns
+	the best move of the last completed depth, or None when should_stop cancels the search. The first depth is
+	completed however long it takes.
+	progress(nodes, depth) is called at every node with the depth being searched.
+	"""
+	memory_board = AiMemoryBoard(board.turn)
 	memory_board.get_setup_from_board(board)
 	
-	return memory_board.find_best_move()
+	# SOLVED ENDINGS NEED NO SEARCH
+	move = memory_board.tablebase_move()
+	if move is not None:
+		return move
+	
+	deadline = time.perf_counter() + seconds
+	searching = 1
+	
+	def stop():
+		if should_stop is not None and should_stop():
+			return True
+		if progress is not None:
+			progress(memory_board.nodes, searching)
+		# THE FIRST DEPTH IS ALWAYS COMPLETED, SO EVERY MOVE IS LOOKED AT ONCE
+		return searching > 1 and time.perf_counter() >= deadline
+	
+	def report(depth, results):
+		nonlocal searching
+		searching = depth + 1
+	
+	memory_board.should_stop = stop
+	results = memory_board.think(max_depth, report=report)
+	if should_stop is not None and should_stop():
+		return None
+	
+	if not results:
+		return None
+	
+	# ONLY THE FIRST SCORE IS EXACT, THE OTHER MOVES WERE SEARCHED WITH A WINDOW AND ONLY BOUND THEIRS
+	best_score, best_move = results[0]
+	
+	print("--- Decided on", to_coords(best_move[0]), "->", to_coords(best_move[1]), ":", score_text(best_score), "---")
+	return best_move
 	
 def get_ai_promotion(board, sq, kinds):
 	side = board.squares[sq].side
@@ -343,14 +904,93 @@ def get_ai_promotion(board, sq, kinds):
 			best_score = score
 			best_kind = kind
 			
-		elif side == 1 and score_sort_key(score) > score_sort_key(best_score):
+		elif side == 1 and score > best_score:
 			best_score = score
 			best_kind = kind
 			
-		elif side == 2 and score_sort_key(score) < score_sort_key(best_score):
+		elif side == 2 and score < best_score:
 			best_score = score
 			best_kind = kind
 
 	return best_kind
-		
-		
+
+
+def ai_worker(shared_name, latest, requests, replies, nodes, depth):
+	shared = shared_memory.SharedMemory(name=shared_name)
+	board = Board()
+	
+	def progress(searched, reached):
+		nodes.value = searched
+		depth.value = reached
+	
+	while True:
+		request_id = requests.get()
+		if request_id is None:
+			break
+		if request_id != latest.value:
+			continue
+		
+		board.unpack(bytes(shared.buf[:PACKED_SIZE]))
+		move = get_ai_move(board, should_stop=lambda: latest.value != request_id, progress=progress)
+		if move is not None:
+			replies.put((request_id, move))
+	
+	shared.close()
+
+
+class AiProcess():
+	"""
+	Persistent worker process searching for moves without holding the GIL of the UI.
+	Positions are passed as a packed board in shared memory, moves come back through a queue.
+	"""
+	
+	def __init__(self):
+		self.shared = shared_memory.SharedMemory(create=True, size=PACKED_SIZE)
+		self.latest = multiprocessing.Value("i", 0, lock=False)
+		self.requests = multiprocessing.Queue()
+		self.replies = multiprocessing.Queue()
+		self.thinking = False
+		
+		# PROGRESS OF THE CURRENT SEARCH, FOR THE PERFORMANCE OVERLAY
+		self.nodes = multiprocessing.Value("q", 0, lock=False)
+		self.depth = multiprocessing.Value("i", 0, lock=False)
+		self.started = 0
+		
+		self.process = multiprocessing.Process(
+			target=ai_worker,
+			args=(self.shared.name, self.latest, self.requests, self.replies, self.nodes, self.depth),
+			daemon=True
+		)
+		self.process.start()
+		
+	def start(self, board):
+		self.latest.value += 1
+		self.shared.buf[:PACKED_SIZE] = board.pack()
+		self.nodes.value = 0
+		self.depth.value = 0
+		self.started = time.perf_counter()
+		self.requests.put(self.latest.value)
+		self.thinking = True
+		
+	def poll(self):
+		# Returns the move found for the latest position, or None while still thinking.
+		while self.thinking:
+			try:
+				request_id, move = self.replies.get_nowait()
+			except queue.Empty:
+				return None
+			if request_id == self.latest.value:
+				self.thinking = False
+				return move
+		return None
+		
+	def cancel(self):
+		self.latest.value += 1
+		self.thinking = False
+		
+	def close(self):
+		self.cancel()
+		self.requests.put(None)
+		self.process.join(1)
+		self.shared.close()
+		self.shared.unlink()
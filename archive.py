@@ -0,0 +1,186 @@
+import mmap
+import os
+import struct
+
+from board import Board, KINDS, KIND_CODES, PACKED_SIZE
+from util import KEYFRAME_INTERVAL
+
+MAGIC = b"FCGA"
+
+HEADER = struct.Struct("<4sIQ")     # Magic, number of games, offset of the index.
+INDEX_ENTRY = struct.Struct("<QI")  # Offset and number of plies of a game.
+MOVE_SIZE = 3                       # From square, to square, promotion kind code (0 for none).
+CLOCK_SIZE = 2                      # Remaining seconds of the side that moved, signed.
+
+# A game is stored as its packed start position, followed by all moves, all clocks and
+# a packed keyframe after every KEYFRAME_INTERVAL plies. The index of all games is at the
+# end of the file, so that new games can be appended by rewriting only the index.
+
+
+def play(board, from_sq, to_sq, promotion=None):
+    promote_idx = 0
+    if promotion is not None:
+        promote_idx = board.squares[from_sq].promotion_pieces().index(promotion)
+    board.move_raw(from_sq, to_sq, promote_idx=promote_idx)
+
+
+class GameRecord:
+    def __init__(self, board):
+        self.start = board.pack()
+        self.moves = bytearray()
+        self.clocks = []
+
+    def __len__(self):
+        return len(self.clocks)
+
+    def add(self, from_sq, to_sq, promotion=None, clock=0):
+        self.moves += bytes([from_sq, to_sq, 0 if promotion is None else KIND_CODES[promotion]])
+        self.clocks.append(clock)
+
+    def encode(self):
+        board = Board()
+        board.unpack(self.start)
+        keyframes = []
+        for ply in range(len(self)):
+            from_sq, to_sq, code = self.moves[ply * MOVE_SIZE:(ply + 1) * MOVE_SIZE]
+            play(board, from_sq, to_sq, KINDS[code - 1] if code else None)
+            if (ply + 1) % KEYFRAME_INTERVAL == 0:
+                keyframes.append(board.pack())
+
+        clocks = struct.pack(f"<{len(self)}h", *self.clocks)
+        return self.start + bytes(self.moves) + clocks + b"".join(keyframes)
+
+
+def read_index(file, filename):
+    # Returns the index entries and the offset where the games end.
+    magic, count, offset = HEADER.unpack(file.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError(f"{filename} is not a game archive")
+    file.seek(offset)
+    entries = file.read(count * INDEX_ENTRY.size)
+    return [INDEX_ENTRY.unpack_from(entries, i * INDEX_ENTRY.size) for i in range(count)], offset
+
+
+def write_index(file, index, offset):
+    file.seek(offset)
+    for entry in index:
+        file.write(INDEX_ENTRY.pack(*entry))
+    file.truncate()
+    file.seek(0)
+    file.write(HEADER.pack(MAGIC, len(index), offset))
+
+
+def save_games(filename, records):
+    """Appends the records to the archive, creating it if necessary."""
+    mode = "r+b" if os.path.exists(filename) else "w+b"
+    with open(filename, mode) as file:
+        index = []
+        offset = HEADER.size
+
+        if mode == "r+b":
+            index, offset = read_index(file, filename)
+
+        file.seek(offset)
+        for record in records:
+            index.append((offset, len(record)))
+            offset += file.write(record.encode())
+
+        write_index(file, index, offset)
+
+
+def save_game(filename, record, slot=None):
+    """
+    Appends the record to the archive, or overwrites the game at slot with it, so that a game
+    in progress can be saved again without adding copies. Returns the slot of the game.
+    """
+    if slot is None or not os.path.exists(filename):
+        save_games(filename, [record])
+        with open(filename, "rb") as file:
+            return len(read_index(file, filename)[0]) - 1
+
+    with open(filename, "r+b") as file:
+        index, end = read_index(file, filename)
+        offset, _ = index[slot]
+        following = index[slot + 1][0] if slot + 1 < len(index) else end
+        file.seek(following)
+        rest = file.read(end - following)
+
+        data = record.encode()
+        shift = offset + len(data) - following
+        index[slot] = (offset, len(record))
+        index[slot + 1:] = [(start + shift, plies) for start, plies in index[slot + 1:]]
+
+        file.seek(offset)
+        file.write(data)
+        file.write(rest)
+        write_index(file, index, end + shift)
+    return slot
+
+
+class ArchivedGame:
+    def __init__(self, data, offset, plies):
+        self.data = data
+        self.plies = plies
+        self.start = offset
+        self.moves = self.start + PACKED_SIZE
+        self.clocks = self.moves + plies * MOVE_SIZE
+        self.keyframes = self.clocks + plies * CLOCK_SIZE
+
+    def __len__(self):
+        return self.plies
+
+    def move(self, ply):
+        from_sq, to_sq, code = self.data[self.moves + ply * MOVE_SIZE:self.moves + (ply + 1) * MOVE_SIZE]
+        return from_sq, to_sq, KINDS[code - 1] if code else None
+
+    def clock(self, ply):
+        return struct.unpack_from("<h", self.data, self.clocks + ply * CLOCK_SIZE)[0]
+
+    def position(self, ply=None):
+        """Returns the board after the given number of plies, replaying from the closest keyframe."""
+        if ply is None:
+            ply = self.plies
+        if not 0 <= ply <= self.plies:
+            raise IndexError(f"Ply {ply} out of range")
+
+        keyframe = ply // KEYFRAME_INTERVAL
+        if keyframe:
+            offset = self.keyframes + (keyframe - 1) * PACKED_SIZE
+        else:
+            offset = self.start
+
+        board = Board()
+        board.unpack(self.data[offset:offset + PACKED_SIZE])
+        for i in range(keyframe * KEYFRAME_INTERVAL, ply):
+            play(board, *self.move(i))
+        return board
+
+
+class Archive:
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count, self.index = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{filename} is not a game archive")
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(f"Game {i} out of range")
+        offset, plies = INDEX_ENTRY.unpack_from(self.data, self.index + i * INDEX_ENTRY.size)
+        return ArchivedGame(self.data, offset, plies)
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,6 +1,24 @@
+import random
+import struct
+from threading import Event, Lock, Thread
+
 from pieces import *
 from util import *
 
+KINDS = list(Kind)
+KIND_CODES = {kind: i + 1 for i, kind in enumerate(KINDS)}
+PACKED_STATE = struct.Struct("<Bhh")  # Turn and en passant pair.
+PACKED_SIZE = BOARD_SIZE ** 2 + PACKED_STATE.size
+MAX_KEYFRAMES = 64
+STRAIGHT_RIDERS = (Kind.ROOK, Kind.BISHOP, Kind.QUEEN, Kind.DRAGONWOMAN, Kind.DIABLO, Kind.UNICORN,
+                   Kind.CANNON, Kind.BOW, Kind.STAR)
+
+# Hash of the placement of Pawns and Centurions only, for caching pawn structure terms.
+PAWN_KINDS = (Kind.PAWN, Kind.CENTURION)
+_pawn_random = random.Random(1621)
+PAWN_ZOBRIST = {(side, kind): [_pawn_random.getrandbits(64) for _ in range(BOARD_SIZE ** 2)]
+                for side in (1, 2) for kind in PAWN_KINDS}
+
 class Board:
     def __init__(self, turn=1):
         self.size = BOARD_SIZE
@@ -12,6 +30,7 @@ class Board:
                                     # The piece at sq2 can be taken en passant as though it only moved to sq1.
         self.side_1_worth = 0
         self.side_2_worth = 0
+        self.pawn_key = 0
 
     def clear(self):
         self.squares = [None] * (self.size ** 2)
@@ -22,6 +41,7 @@ class Board:
         
         self.side_1_worth = 0
         self.side_2_worth = 0
+        self.pawn_key = 0
     
     def remove_piece(self, sq):
         piece = self.squares[sq]
@@ -30,6 +50,8 @@ class Board:
                 self.side_1_worth -= WORTHS[piece.kind.value]
             else:
                 self.side_2_worth -= WORTHS[piece.kind.value]
+            if piece.kind in PAWN_KINDS:
+                self.pawn_key ^= PAWN_ZOBRIST[piece.side, piece.kind][sq]
             self.squares[sq] = None
         
     
@@ -43,6 +65,8 @@ class Board:
             self.side_1_worth += WORTHS[kind.value]
         else:
             self.side_2_worth += WORTHS[kind.value]
+        if kind in PAWN_KINDS:
+            self.pawn_key ^= PAWN_ZOBRIST[side, kind][sq]
             
     def place_piece(self, piece, square=0, xy=None):
         sq = square if xy is None else to_square(xy)
@@ -54,6 +78,8 @@ class Board:
             self.side_1_worth += WORTHS[piece.kind.value]
         else:
             self.side_2_worth += WORTHS[piece.kind.value]
+        if piece.kind in PAWN_KINDS:
+            self.pawn_key ^= PAWN_ZOBRIST[piece.side, piece.kind][sq]
             
     def change_piece_kind(self, sq, new_kind):
         piece = self.squares[sq]
@@ -64,6 +90,10 @@ class Board:
             self.side_1_worth += (WORTHS[new_kind.value] - WORTHS[piece.kind.value])
         else:
             self.side_2_worth += (WORTHS[new_kind.value] - WORTHS[piece.kind.value])
+        if piece.kind in PAWN_KINDS:
+            self.pawn_key ^= PAWN_ZOBRIST[piece.side, piece.kind][sq]
+        if new_kind in PAWN_KINDS:
+            self.pawn_key ^= PAWN_ZOBRIST[piece.side, new_kind][sq]
             
         piece.kind = new_kind
         
@@ -76,12 +106,22 @@ class Board:
         side = 1
         for line in content:
             if line == "\n":
-                side = 2
+                side += 1
                 continue
-            kind_name, square = line.strip().split()
+            words = line.split()
+
+            # AN OPTIONAL THIRD SECTION HOLDS THE SIDE TO MOVE AND EN PASSANT
+            if side > 2:
+                if words[0] == "TURN":
+                    self.turn = int(words[1])
+                elif words[0] == "EN_PASSANT":
+                    self.en_passant = (int(words[1]), int(words[2]))
+                continue
+
+            kind_name, square = words
             self.create_piece(side, Kind[kind_name], int(square))
 
-    def write_file(self, filename):
+    def write_file(self, filename, state=False):
         side1 = []
         side2 = []
 
@@ -94,7 +134,25 @@ class Board:
             file.writelines(side1)
             file.write("\n")
             file.writelines(side2)
+            if state:
+                file.write(f"\nTURN {self.turn}\nEN_PASSANT {self.en_passant[0]} {self.en_passant[1]}\n")
             
+    def pack(self):
+        # One byte per square: 0 for empty, otherwise the kind code, offset by len(Kind) for side 2.
+        codes = bytes(0 if piece is None else (piece.side - 1) * len(KINDS) + KIND_CODES[piece.kind]
+                      for piece in self.squares)
+        return codes + PACKED_STATE.pack(self.turn, *self.en_passant)
+
+    def unpack(self, data):
+        self.clear()
+        for sq, code in enumerate(data[:self.size ** 2]):
+            if code:
+                side, kind = divmod(code - 1, len(KINDS))
+                self.create_piece(side + 1, KINDS[kind], sq)
+
+        self.turn, *en_passant = PACKED_STATE.unpack_from(data, self.size ** 2)
+        self.en_passant = tuple(en_passant)
+
     def make_copy(self):
         new_board = Board()
         
@@ -102,6 +160,7 @@ class Board:
         new_board.en_passant = self.en_passant
         new_board.side_1_worth = self.side_1_worth
         new_board.side_2_worth = self.side_2_worth
+        new_board.pawn_key = self.pawn_key
         
         for sq in range(self.size ** 2):
             if self.squares[sq] is not None:
@@ -127,9 +186,12 @@ class Board:
         for line in reversed(lines):
             print(line)
 
-    def ray(self, side, origin, directions, max_length=-1):
+    def ray(self, side, origin, directions, max_length=-1, mode=ALL_MOVES):
         move_squares = set()
         capture_squares = set()
+        quiets = mode == ALL_MOVES or mode == QUIETS
+        captures = mode != QUIETS
+        defends = mode == ATTACKS
         for direction in directions:
             increment, border = direction
             square = origin
@@ -138,17 +200,22 @@ class Board:
                 square += increment
                 length += 1
                 if 0 <= square < (self.size ** 2):
-                    if self.squares[square] is None:
-                        move_squares.add(square)
+                    target = self.squares[square]
+                    if target is None:
+                        if quiets:
+                            move_squares.add(square)
                         continue
-                    elif self.squares[square].side != side:
+                    elif captures and (defends or target.side != side):
                         capture_squares.add(square)
                 break
         return move_squares, capture_squares
 
-    def knights_move(self, side, origin, ab=(2, 1)):
+    def knights_move(self, side, origin, ab=(2, 1), mode=ALL_MOVES):
         move_squares = set()
         capture_squares = set()
+        quiets = mode == ALL_MOVES or mode == QUIETS
+        captures = mode != QUIETS
+        defends = mode == ATTACKS
         ox, oy = to_coords(origin)
         a, b = ab
         for d1 in {a, -a}:
@@ -156,30 +223,35 @@ class Board:
                 for x, y in {(ox + d1, oy + d2), (ox + d2, oy + d1)}:
                     if 0 <= x < self.size and 0 <= y < self.size:
                         square = to_square((x, y))
-                        if self.squares[square] is None:
-                            move_squares.add(square)
-                        elif self.squares[square].side != side:
+                        target = self.squares[square]
+                        if target is None:
+                            if quiets:
+                                move_squares.add(square)
+                        elif captures and (defends or target.side != side):
                             capture_squares.add(square)
         return move_squares, capture_squares
 
-    def artillery(self, side, origin, directions):
+    def artillery(self, side, origin, directions, mode=ALL_MOVES):
         move_squares = set()
         capture_squares = set()
+        quiets = mode == ALL_MOVES or mode == QUIETS
+        defends = mode == ATTACKS
+        # QUIET MOVES END AT THE SCREEN, CAPTURES NEED THE PIECE BEHIND IT
+        blocks = 1 if mode == QUIETS else 2
         for direction in directions:
             increment, border = direction
             square = origin
             block = 0
-            while square % self.size != border and block < 2:
+            while square % self.size != border and block < blocks:
                 square += increment
                 if 0 <= square < (self.size ** 2):
-                    if self.squares[square] is None:
-                        if block == 0:
+                    target = self.squares[square]
+                    if target is None:
+                        if block == 0 and quiets:
                             move_squares.add(square)
-                    elif self.squares[square].side != side:
-                        if block == 1:
-                            capture_squares.add(square)
-                        block += 1
                     else:
+                        if block == 1 and (defends or target.side != side):
+                            capture_squares.add(square)
                         block += 1
                 else:
                     break
@@ -226,7 +298,7 @@ class Board:
         for piece in self.squares:
             if piece is not None:
                 if piece.side != side:
-                    _, captures = piece.move_and_capture_squares(self, check_check=False)
+                    _, captures = piece.move_and_capture_squares(self, check_check=False, mode=CAPTURES)
                     for cap in captures:
                         if cap != self.en_passant[0]:
                             if self.squares[cap].kind == Kind.KING:
@@ -246,51 +318,363 @@ class Board:
     def check_mate(self, side=0):  # output: 0 = no mate, 1 = stalemate, 2 = checkmate
         if side == 0:
             side = self.turn
+        checkers = self.checkers(side)
+        if checkers:
+            if self.evasions(side, checkers):
+                return 0
+            self.finished = True
+            return 2
+
         for piece in self.squares:
             if piece is not None:
                 if piece.side == side:
                     if piece.move_and_capture_squares(self) != (set(), set()):
                         return 0
         self.finished = True
-        if self.in_check(side):
-            return 2
         return 1
+
+    def king_square(self, side):
+        for sq, piece in enumerate(self.squares):
+            if piece is not None and piece.side == side and piece.kind == Kind.KING:
+                return sq
+        return None
+
+    def checkers(self, side=0):
+        if side == 0:
+            side = self.turn
+        king = self.king_square(side)
+        if king is None:
+            return []
+        return [sq for sq, piece in enumerate(self.squares) if piece is not None and piece.side != side
+                and king in piece.move_and_capture_squares(self, check_check=False, mode=CAPTURES)[1]]
+
+    def check_line(self, checker, king):
+        # Squares whose occupation decides whether the checker still attacks the king:
+        # the squares between them, including the screen of an artillery piece.
+        piece = self.squares[checker]
+        if piece.kind in STRAIGHT_RIDERS:
+            (x1, y1), (x2, y2) = to_coords(checker), to_coords(king)
+            dx, dy = x2 - x1, y2 - y1
+            if dx != 0 and dy != 0 and abs(dx) != abs(dy):
+                return set()
+            length = max(abs(dx), abs(dy))
+            step_x, step_y = dx // length, dy // length
+            return {to_square((x1 + i * step_x, y1 + i * step_y)) for i in range(1, length)}
+
+        if piece.kind in BENT_RIDERS:
+            line = set()
+            for sq in piece.move_and_capture_squares(self, check_check=False, mode=QUIETS)[0]:
+                self.squares[sq] = piece  # Any piece blocks the path.
+                if king not in piece.move_and_capture_squares(self, check_check=False, mode=CAPTURES)[1]:
+                    line.add(sq)
+                self.squares[sq] = None
+            return line
+
+        return set()
+
+    def evasion_candidates(self, side, checkers):
+        """
+        Pseudo-legal (from, to, is capture) moves that can answer the check: king moves, captures
+        of a checker, and moves that change the occupation of a check line, be it by blocking it
+        or by moving or capturing an artillery screen. Legality still has to be tested.
+        """
+        king = self.king_square(side)
+        relevant = set(checkers)
+        for checker in checkers:
+            relevant |= self.check_line(checker, king)
+        en_passant_relevant = self.en_passant[1] in relevant
+
+        candidates = []
+        for sq, piece in enumerate(self.squares):
+            if piece is None or piece.side != side:
+                continue
+            moves, captures = piece.move_and_capture_squares(self, check_check=False)
+            for to_sq in moves | captures:
+                if piece.kind == Kind.KING or sq in relevant or to_sq in relevant or (
+                        en_passant_relevant and to_sq == self.en_passant[0] and piece.kind in (Kind.PAWN, Kind.CENTURION)):
+                    candidates.append((sq, to_sq, to_sq in captures))
+        return candidates
+
+    def evasions(self, side=0, checkers=None):
+        # Legal moves and captures by square, for a side in check.
+        if side == 0:
+            side = self.turn
+        if checkers is None:
+            checkers = self.checkers(side)
+
+        legal = dict()
+        for from_sq, to_sq, capture in self.evasion_candidates(side, checkers):
+            if self.check_move_for_check(from_sq, to_sq):
+                moves, captures = legal.setdefault(from_sq, (set(), set()))
+                (captures if capture else moves).add(to_sq)
+        return legal
         
     def get_worths(self):
         return self.side_1_worth, self.side_2_worth
         
+class MoveHistory:
+    """
+    Reversible deltas of all plies, plus a packed keyframe every interval plies.
+    A delta is (squares, before, after, en_passant_before, en_passant_after, turn_before, turn_after, highlight).
+    """
+
+    def __init__(self):
+        self.deltas = []
+        self.keyframes = []
+        self.interval = KEYFRAME_INTERVAL
+        self.ply = 0
+
+    def __len__(self):
+        return len(self.deltas)
+
+    def push(self, delta, board):
+        del self.deltas[self.ply:]
+        self.deltas.append(delta)
+        self.ply += 1
+
+        if self.ply % self.interval == 0 and len(self.keyframes) == self.ply // self.interval:
+            self.keyframes.append(board.pack())
+
+        # Thin out the keyframes in long games to keep memory bounded.
+        if len(self.keyframes) > MAX_KEYFRAMES:
+            self.keyframes = self.keyframes[::2]
+            self.interval *= 2
+
+
+class LegalMoves:
+    """
+    Legal moves and captures of the side to move by square, for one position.
+    Squares are filled in by a background thread, or on demand if they are needed first.
+    """
+
+    def __init__(self, board, key):
+        self.key = key
+        self.board = board.make_copy()  # The displayed board changes while the thread runs.
+        self.squares = dict()
+        self.lock = Lock()
+        self.done = Event()
+        self.cancelled = False
+        self.check_lock = Lock()
+        self.checked = None
+        self.evasions = None
+
+    def check_evasions(self):
+        # Moves of a side in check come from the evasion generator, or None if not in check.
+        with self.check_lock:
+            if self.checked is None:
+                checkers = self.board.checkers()
+                self.checked = bool(checkers)
+                if checkers:
+                    self.evasions = self.board.evasions(checkers=checkers)
+        return self.evasions
+
+    def get(self, sq):
+        with self.lock:
+            legal = self.squares.get(sq)
+        if legal is None:
+            piece = self.board.squares[sq]
+            evasions = self.check_evasions()
+            if piece is None or piece.side != self.board.turn:
+                legal = set(), set()
+            elif evasions is not None:
+                legal = evasions.get(sq, (set(), set()))
+            else:
+                legal = piece.move_and_capture_squares(self.board)
+            with self.lock:
+                legal = self.squares.setdefault(sq, legal)
+        return legal
+
+    def fill(self):
+        for sq, piece in enumerate(self.board.squares):
+            if self.cancelled:
+                return
+            if piece is not None and piece.side == self.board.turn:
+                self.get(sq)
+        self.done.set()
+
+
 class DisplayedBoard(Board):
     def __init__(self, turn=1):
         Board.__init__(self, turn)
            
         self.highlighted_squares = tuple()
-        self.captured_kind = None
         self.promoting = False
+        self.history = MoveHistory()
+        self.pending = None
+        self.version = 0
+        self.legal = None
         
     def clear(self):
         Board.clear(self)
         
         self.highlighted_squares = tuple()
-        self.captured_kind = None
         self.promoting = False
-        
+        self.history = MoveHistory()
+        self.pending = None
+        self.version += 1
+
+    # Every change of a square makes the cached legal moves stale.
+    def remove_piece(self, sq):
+        self.version += 1
+        Board.remove_piece(self, sq)
+
+    def create_piece(self, side, kind, square=0, xy=None):
+        self.version += 1
+        Board.create_piece(self, side, kind, square, xy)
+
+    def place_piece(self, piece, square=0, xy=None):
+        self.version += 1
+        Board.place_piece(self, piece, square, xy)
+
+    def change_piece_kind(self, sq, new_kind):
+        self.version += 1
+        Board.change_piece_kind(self, sq, new_kind)
+
+    def legal_key(self):
+        return self.version, self.turn, self.en_passant
+
+    def update_legal_moves(self, background=True):
+        if self.legal is not None and self.legal.key == self.legal_key():
+            return self.legal
+        if self.legal is not None:
+            self.legal.cancelled = True
+
+        self.legal = LegalMoves(self, self.legal_key())
+        if background:
+            Thread(target=self.legal.fill, daemon=True).start()
+        return self.legal
+
+    def legal_moves(self, sq):
+        # Same as possible_moves with check_side, but an empty pair for empty squares.
+        return self.update_legal_moves(background=False).get(sq)
+
+    def check_mate(self, side=0):
+        if side not in (0, self.turn):
+            return Board.check_mate(self, side)
+
+        for sq, piece in enumerate(self.squares):
+            if piece is not None and piece.side == self.turn:
+                if self.legal_moves(sq) != (set(), set()):
+                    return 0
+        self.finished = True
+        if self.update_legal_moves(background=False).check_evasions() is not None:
+            return 2
+        return 1
+
+    def state(self, sq):
+        piece = self.squares[sq]
+        return None if piece is None else (piece.side, piece.kind)
+
+    def set_state(self, sq, state):
+        if state is None:
+            self.remove_piece(sq)
+        else:
+            self.create_piece(*state, sq)
+
+    def pack_settled(self):
+        # Packs the position without a move that still waits for its promotion choice.
+        if self.pending is None:
+            return self.pack()
+
+        squares, before, en_passant, turn = self.pending
+        after = tuple(self.state(sq) for sq in squares)
+        current = self.en_passant, self.turn
+        for sq, state in zip(squares, before):
+            self.set_state(sq, state)
+        self.en_passant, self.turn = en_passant, turn
+        data = self.pack()
+
+        for sq, state in zip(squares, after):
+            self.set_state(sq, state)
+        self.en_passant, self.turn = current
+        return data
+
+    @property
+    def reviewing(self):
+        return self.history.ply < len(self.history)
+
+    def begin_ply(self, squares):
+        if not self.history.keyframes:
+            self.history.keyframes.append(self.pack())
+        self.pending = (squares, tuple(self.state(sq) for sq in squares), self.en_passant, self.turn)
+
+    def end_ply(self):
+        squares, before, en_passant, turn = self.pending
+        after = tuple(self.state(sq) for sq in squares)
+        delta = (squares, before, after, en_passant, self.en_passant, turn, self.turn, self.highlighted_squares)
+        self.history.push(delta, self)
+        self.pending = None
+        # The background thread starts with the first ply, the position before it is filled in on demand.
+        self.update_legal_moves()
+
+    def undo(self):
+        if self.history.ply == 0:
+            return False
+
+        self.history.ply -= 1
+        squares, before, _, en_passant, _, turn, _, _ = self.history.deltas[self.history.ply]
+        for sq, state in zip(squares, before):
+            self.set_state(sq, state)
+        self.en_passant = en_passant
+        self.turn = turn
+
+        self.highlighted_squares = self.history.deltas[self.history.ply - 1][-1] if self.history.ply else tuple()
+        return True
+
+    def redo(self):
+        if not self.reviewing:
+            return False
+
+        squares, _, after, _, en_passant, _, turn, highlight = self.history.deltas[self.history.ply]
+        self.history.ply += 1
+        for sq, state in zip(squares, after):
+            self.set_state(sq, state)
+        self.en_passant = en_passant
+        self.turn = turn
+
+        self.highlighted_squares = highlight
+        return True
+
+    def seek(self, ply=None):
+        # Jumps to the position after the given ply, by default the current position of the game.
+        history = self.history
+        ply = len(history) if ply is None else max(0, min(ply, len(history)))
+
+        if abs(ply - history.ply) > history.interval:
+            keyframe = ply // history.interval
+            finished = self.finished
+            self.unpack(history.keyframes[keyframe])  # Clears the board including its history.
+            self.history = history
+            self.finished = finished
+            history.ply = keyframe * history.interval
+
+        while history.ply > ply:
+            self.undo()
+        while history.ply < ply:
+            self.redo()
+        self.highlighted_squares = history.deltas[ply - 1][-1] if ply else tuple()
+
     def move(self, from_sq, to_sq):
+        self.seek()
         mocap = "Move" if self.squares[to_sq] is None else "Capture"
         
-        # LIST ALL POSSIBLE MOVES FOR VERIFICATION
+        # LOOK UP ALL POSSIBLE MOVES FOR VERIFICATION
         
-        moves = self.possible_moves(from_sq, check_side=True)
-        if moves is None:
+        if self.squares[from_sq] is None:
             return "Invalid", mocap
                 
+        moves = self.legal_moves(from_sq)
         moves = moves[0] | moves[1]
         
         if to_sq in moves:
             
             piece = self.squares[from_sq]
+            if to_sq == self.en_passant[0] and piece.kind in [Kind.PAWN, Kind.CENTURION]:
+                self.begin_ply((from_sq, to_sq, self.en_passant[1]))
+            else:
+                self.begin_ply((from_sq, to_sq))
             
             self.highlighted_squares = (from_sq, to_sq)
-            self.captured_kind = None if mocap == "Move" else self.squares[to_sq].kind
         
             # REMOVE PIECE THAT IS TAKEN EN PASSANT
             if self.en_passant[0] >= 0:
@@ -298,7 +682,6 @@ class DisplayedBoard(Board):
                 if to_sq == self.en_passant[0] and piece.kind in [Kind.PAWN, Kind.CENTURION]:
                     
                     self.highlighted_squares = (*self.highlighted_squares, self.en_passant[1])
-                    self.captured_kind = self.squares[self.en_passant[1]].kind
                     self.remove_piece(self.en_passant[1])
                     mocap = "Capture"
 
@@ -323,6 +706,7 @@ class DisplayedBoard(Board):
                     return options, mocap
 
             self.turn = 3 - self.turn
+            self.end_ply()
             mate = self.check_mate()
             
             if mate == 1:
@@ -342,10 +726,13 @@ class DisplayedBoard(Board):
             return "Invalid"
         if kind not in piece.promotion_pieces():
             return "Invalid"
+        if self.pending is None:
+            return "Invalid"
         
         self.change_piece_kind(sq, kind)
         
         self.turn = 3 - self.turn
+        self.end_ply()
         mate = self.check_mate()
         
         if mate == 1:
@@ -0,0 +1,275 @@
+"""
+Long-running engine speaking a UCI-like line protocol on stdin and stdout.
+
+    uci | isready | ucinewgame | quit
+    position startpos | file <path.pos> [turn 1|2] [moves <move> ...]
+    go [depth <n>] [movetime <ms>] [nodes <n>] [infinite] [ponder]
+    stop | ponderhit
+    setoption name MultiPV value <n>
+    setoption name SEEPruning|NullMove|LateMoveReductions|Futility value true|false
+
+Moves are written as coordinates from a1 to p16, e.g. h14h12, followed by the
+lowercase name of the promotion kind if there is a choice, e.g. c15c16gryphon.
+The transposition table is kept between commands until ucinewgame.
+"""
+
+import re
+import sys
+import time
+from threading import Thread, Event
+
+from ai import AiMemoryBoard, mate_plies, score_terms
+from board import Board
+from pieces import Kind
+from util import to_coords, to_square
+
+MAX_DEPTH = 64
+SWITCHES = {  # Check options mapped to the AiMemoryBoard attribute they toggle.
+    "seepruning": "see_pruning",
+    "nullmove": "null_move_pruning",
+    "latemovereductions": "late_move_reductions",
+    "futility": "futility_pruning",
+}
+MOVE_PATTERN = re.compile(r"([a-p])(\d+)([a-p])(\d+)([a-z]*)")
+
+
+def format_square(sq):
+    x, y = to_coords(sq)
+    return f"{chr(ord('a') + x)}{y + 1}"
+
+
+def format_move(move):
+    # Moves with a choice of promotion carry the kind as a third element.
+    promotion = move[2].name.lower() if len(move) > 2 and move[2] is not None else ""
+    return format_square(move[0]) + format_square(move[1]) + promotion
+
+
+def parse_move(text):
+    match = MOVE_PATTERN.fullmatch(text)
+    if match is None:
+        raise ValueError(f"Invalid move {text}")
+    x1, y1, x2, y2, kind = match.groups()
+    from_sq = to_square((ord(x1) - ord("a"), int(y1) - 1))
+    to_sq = to_square((ord(x2) - ord("a"), int(y2) - 1))
+    return from_sq, to_sq, Kind[kind.upper()] if kind else None
+
+
+def format_score(score, turn):
+    mate, material, attacks, positional = score_terms(score)
+    sign = 1 if turn == 1 else -1
+    if mate:
+        return f"mate {sign * mate * ((mate_plies(score) + 1) // 2)}"
+    return f"cp {round(sign * 100 * (material + attacks + positional))}"
+
+
+def load_position(filename, turn=1, moves=()):
+    # Moves are (from, to, promotion kind or None), as returned by parse_move.
+    position = Board(turn)
+    position.setup_file(filename)
+    position.turn = turn
+
+    for from_sq, to_sq, kind in moves:
+        piece = position.squares[from_sq]
+        if piece is None:
+            raise ValueError(f"No piece on {format_square(from_sq)}")
+        options = piece.promotion_pieces()
+        position.move_raw(from_sq, to_sq, promote_idx=options.index(kind) if kind is not None else 0)
+    return position
+
+
+class Engine:
+    def __init__(self, output=sys.stdout):
+        self.output = output
+        self.board = AiMemoryBoard(1)
+        self.multipv = 1
+        self.thread = None
+        self.stopped = Event()
+        self.pondering = False
+        self.deadline = None
+        self.movetime = None
+        self.node_limit = None
+        self.infinite = False
+        self.start_time = 0
+
+        self.board.should_stop = self.should_stop
+        self.set_position("resources/default_moab.pos")
+
+    def send(self, line):
+        print(line, file=self.output, flush=True)
+
+    def should_stop(self):
+        if self.stopped.is_set():
+            return True
+        if self.pondering:
+            return False
+        if self.node_limit is not None and self.board.nodes >= self.node_limit:
+            return True
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def set_position(self, filename, turn=1, moves=()):
+        position = load_position(filename, turn, moves)
+
+        table = self.board.table
+        self.board.clear()
+        self.board.get_setup_from_board(position)
+        self.board.table = table
+
+    def handle(self, line):
+        words = line.split()
+        if not words:
+            return True
+        command, args = words[0], words[1:]
+
+        if command == "uci":
+            self.send("id name Fairy chess")
+            self.send("option name MultiPV type spin default 1 min 1 max 256")
+            self.send("option name SEEPruning type check default true")
+            self.send("option name NullMove type check default true")
+            self.send("option name LateMoveReductions type check default true")
+            self.send("option name Futility type check default true")
+            self.send("uciok")
+
+        elif command == "isready":
+            self.send("readyok")
+
+        elif command == "ucinewgame":
+            self.stop()
+            self.board.table.clear()
+
+        elif command == "setoption":
+            if len(args) == 4 and args[0] == "name" and args[2] == "value":
+                name = args[1].lower()
+                if name == "multipv":
+                    self.multipv = max(1, int(args[3]))
+                elif name in SWITCHES:
+                    setattr(self.board, SWITCHES[name], args[3].lower() == "true")
+
+        elif command == "position":
+            self.stop()
+            self.position(args)
+
+        elif command == "go":
+            self.stop()
+            self.go(args)
+
+        elif command == "stop":
+            self.stop()
+
+        elif command == "ponderhit":
+            if self.movetime is not None:
+                self.deadline = time.time() + self.movetime
+            self.pondering = False
+
+        elif command == "quit":
+            self.stop()
+            return False
+
+        else:
+            self.send(f"info string Unknown command {command}")
+        return True
+
+    def position(self, args):
+        filename = "resources/default_moab.pos"
+        turn = 1
+        moves = []
+
+        i = 0
+        while i < len(args):
+            if args[i] == "startpos":
+                i += 1
+            elif args[i] == "file":
+                filename = args[i + 1]
+                i += 2
+            elif args[i] == "turn":
+                turn = int(args[i + 1])
+                i += 2
+            elif args[i] == "moves":
+                moves = [parse_move(move) for move in args[i + 1:]]
+                break
+            else:
+                raise ValueError(f"Unexpected {args[i]}")
+
+        self.set_position(filename, turn, moves)
+
+    def go(self, args):
+        depth = MAX_DEPTH
+        self.movetime = None
+        self.node_limit = None
+        self.pondering = "ponder" in args
+        self.infinite = "infinite" in args
+
+        for name, value in zip(args, args[1:]):
+            if name == "depth":
+                depth = int(value)
+            elif name == "movetime":
+                self.movetime = int(value) / 1000
+            elif name == "nodes":
+                self.node_limit = int(value)
+
+        self.start_time = time.time()
+        self.deadline = None if self.infinite or self.movetime is None else self.start_time + self.movetime
+        # A bare go answers after one ply, pondering and infinite searches run until ponderhit or stop.
+        if self.movetime is None and self.node_limit is None and depth == MAX_DEPTH and not self.infinite and not self.pondering:
+            depth = 1
+
+        self.stopped.clear()
+        self.thread = Thread(target=self.think, args=(depth,), daemon=True)
+        self.thread.start()
+
+    def think(self, depth):
+        results = self.board.think(depth, multipv=self.multipv, report=self.report)
+
+        if results:
+            best = results[0][1]
+        else:
+            # Stopped before the first move was searched.
+            moves = self.board.legal_moves()
+            if not moves:
+                self.send("bestmove (none)")
+                return
+            best = moves[0]
+
+        line = f"bestmove {format_move(best)}"
+        self.board.move(*best)
+        reply = self.board.principal_variation(1)
+        self.board.revert()
+        if reply:
+            line += f" ponder {format_move(reply[0])}"
+        self.send(line)
+
+    def report(self, depth, results):
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        nodes = self.board.nodes
+        for i, (score, move) in enumerate(results[:self.multipv]):
+            self.board.move(*move)
+            pv = [move] + self.board.principal_variation(depth - 1)
+            self.board.revert()
+            self.send(f"info multipv {i + 1} depth {depth} score {format_score(score, self.board.turn)} "
+                      f"nodes {nodes} nps {int(nodes / elapsed)} time {int(1000 * elapsed)} "
+                      f"pv {' '.join(format_move(m) for m in pv)}")
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def main():
+    engine = Engine()
+    for line in sys.stdin:
+        try:
+            if not engine.handle(line):
+                break
+        except (ValueError, IndexError, KeyError) as error:
+            engine.send(f"info string {error}")
+    else:
+        # End of input finishes a limited search instead of cutting it short.
+        if engine.infinite or engine.pondering:
+            engine.stop()
+        elif engine.thread is not None:
+            engine.thread.join()
+
+
+if __name__ == "__main__":
+    main()
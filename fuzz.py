@@ -0,0 +1,243 @@
+"""
+Differential fuzzing of move generators against the rules in Piece.move_and_capture_squares and Board.move_raw.
+
+    python fuzz.py [ai | module:function] [--seed n] [--positions n] [--plies n] [--out file.pos]
+    python fuzz.py [ai | module:function] --repro file.pos
+
+A candidate is either "ai", which checks the legal moves and the reversible make-move of
+AiMemoryBoard, or a function taking a Board and returning its legal (from, to) moves, with
+one (from, to, kind) move per kind where a promotion offers a choice.
+Positions come from random games starting at the setups in resources, and from random
+placements of all 24 kinds. The first mismatch is shrunk by removing pieces for as long as
+it persists, and written as a .pos file with the side to move and en passant, which --repro
+checks again.
+"""
+
+import glob
+import importlib
+import random
+import sys
+
+from ai import AiMemoryBoard
+from board import Board, KINDS
+from engine import format_move
+from pieces import Kind
+from util import BOARD_SIZE
+
+SETUPS = "resources/*.pos"
+PLACED_PIECES = (24, 96)  # Range of the number of pieces in random placements.
+EN_PASSANT_CHANCE = 0.5
+
+
+def reference_moves(board):
+    moves = set()
+    for sq, piece in enumerate(board.squares):
+        if piece is not None and piece.side == board.turn:
+            for to_sq in set().union(*piece.move_and_capture_squares(board)):
+                moves.update(promotion_choices(board, sq, to_sq))
+    return moves
+
+
+def play_raw(board, move):
+    from_sq, to_sq, *promotion = move
+    options = board.squares[from_sq].promotion_pieces()
+    board.move_raw(from_sq, to_sq, promote_idx=options.index(promotion[0]) if promotion else 0)
+
+
+def reference_play(board, move):
+    copy = board.make_copy()
+    play_raw(copy, move)
+    return copy.pack()
+
+
+def promotion_choices(board, from_sq, to_sq):
+    piece = board.squares[from_sq]
+    options = piece.promotion_pieces()
+    if len(options) > 1 and to_sq in piece.promotion_squares():
+        return [(from_sq, to_sq, kind) for kind in options]
+    return [(from_sq, to_sq)]
+
+
+class FunctionCandidate:
+    def __init__(self, function):
+        self.moves = function
+
+
+class AiCandidate:
+    def memory_board(self, board):
+        memory_board = AiMemoryBoard(board.turn)
+        memory_board.get_setup_from_board(board)
+        return memory_board
+
+    def moves(self, board):
+        return self.memory_board(board).legal_moves()
+
+    def play(self, board, move):
+        memory_board = self.memory_board(board)
+        before = memory_board.pack()
+        memory_board.move(*move)
+        after = memory_board.pack()
+        memory_board.revert()
+        if memory_board.pack() != before:
+            raise ValueError("revert does not restore the position")
+        return after
+
+
+def load_candidate(name):
+    if name == "ai":
+        return AiCandidate()
+    module, function = name.split(":")
+    return FunctionCandidate(getattr(importlib.import_module(module), function))
+
+
+def mismatch(board, candidate):
+    """Describes the first difference between the candidate and the reference, or returns None."""
+    before = board.pack()
+    expected = reference_moves(board)
+    try:
+        found = set(candidate.moves(board))
+    except Exception as error:
+        return f"moves raised {error!r}"
+    if board.pack() != before:
+        return "moves changed the board"
+
+    if found != expected:
+        missing = " ".join(sorted(format_move(move) for move in expected - found))
+        extra = " ".join(sorted(format_move(move) for move in found - expected))
+        return f"missing [{missing}] extra [{extra}]"
+
+    if hasattr(candidate, "play"):
+        for move in sorted(expected, key=format_move):
+            try:
+                played = candidate.play(board, move)
+            except Exception as error:
+                return f"playing {format_move(move)} raised {error!r}"
+            if played != reference_play(board, move):
+                return f"playing {format_move(move)} gives another position"
+    return None
+
+
+def shrink(board, candidate):
+    board = board.make_copy()
+    shrunk = True
+    while shrunk:
+        shrunk = False
+        if board.en_passant != (-1, -1):
+            trial = board.make_copy()
+            trial.en_passant = (-1, -1)
+            if mismatch(trial, candidate):
+                board = trial
+
+        for sq, piece in enumerate(board.squares):
+            if piece is None:
+                continue
+            trial = board.make_copy()
+            trial.remove_piece(sq)
+            if sq == trial.en_passant[1]:
+                trial.en_passant = (-1, -1)
+            if mismatch(trial, candidate):
+                board = trial
+                shrunk = True
+    return board
+
+
+def random_placement(rng):
+    while True:
+        board = Board(rng.choice((1, 2)))
+        squares = rng.sample(range(BOARD_SIZE ** 2), rng.randint(*PLACED_PIECES))
+
+        # ONE KING PER SIDE, EVERY OTHER KIND AT LEAST ONCE
+        others = [kind for kind in KINDS if kind != Kind.KING]
+        kinds = [Kind.KING, Kind.KING] + others + [rng.choice(others) for _ in range(len(squares) - len(KINDS) - 1)]
+        for i, (sq, kind) in enumerate(zip(squares, kinds)):
+            board.create_piece(i + 1 if i < 2 else rng.choice((1, 2)), kind, sq)
+
+        if rng.random() < EN_PASSANT_CHANCE:
+            set_random_en_passant(board, rng)
+        if not board.in_check(3 - board.turn):
+            return board
+
+
+def set_random_en_passant(board, rng):
+    # A Pawn or Centurion of the side that just moved, as if it had advanced two squares.
+    other = 3 - board.turn
+    step = BOARD_SIZE if other == 1 else -BOARD_SIZE
+    candidates = []
+    for sq, piece in enumerate(board.squares):
+        if piece is not None and piece.side == other and piece.kind in (Kind.PAWN, Kind.CENTURION):
+            passed = sq - step
+            if 0 <= passed < BOARD_SIZE ** 2 and 0 <= passed - step < BOARD_SIZE ** 2:
+                if board.squares[passed] is None and board.squares[passed - step] is None:
+                    candidates.append((passed, sq))
+    if candidates:
+        board.en_passant = rng.choice(candidates)
+
+
+def random_game(rng, setup, plies):
+    board = Board()
+    board.setup_file(setup)
+    for _ in range(plies):
+        yield board
+        moves = sorted(reference_moves(board), key=format_move)
+        if not moves:
+            return
+        play_raw(board, rng.choice(moves))
+
+
+def fuzz(candidate, seed=0, positions=100, plies=40, out="fuzz_repro.pos"):
+    rng = random.Random(seed)
+    setups = sorted(glob.glob(SETUPS))
+    checked = 0
+
+    def boards():
+        while True:
+            for setup in setups:
+                yield from random_game(rng, setup, plies)
+            for _ in range(plies):
+                yield random_placement(rng)
+
+    for board in boards():
+        if checked == positions:
+            break
+        checked += 1
+
+        problem = mismatch(board, candidate)
+        if problem is None:
+            continue
+
+        minimal = shrink(board, candidate)
+        minimal.write_file(out, state=True)
+        print(f"Mismatch in position {checked}: {mismatch(minimal, candidate)}")
+        print(f"Written to {out} with {sum(piece is not None for piece in minimal.squares)} pieces, "
+              f"turn {minimal.turn}, en passant {minimal.en_passant}")
+        return minimal
+
+    print(f"No mismatch in {checked} positions")
+    return None
+
+
+def main(args):
+    name = "ai"
+    options = {"--seed": 0, "--positions": 100, "--plies": 40, "--out": "fuzz_repro.pos", "--repro": None}
+    i = 0
+    while i < len(args):
+        if args[i] in options:
+            options[args[i]] = args[i + 1] if args[i] in ("--out", "--repro") else int(args[i + 1])
+            i += 2
+        else:
+            name = args[i]
+            i += 1
+
+    if options["--repro"] is not None:
+        board = Board()
+        board.setup_file(options["--repro"])
+        problem = mismatch(board, load_candidate(name))
+        print(problem or "No mismatch")
+        sys.exit(problem is not None)
+
+    found = fuzz(load_candidate(name), options["--seed"], options["--positions"], options["--plies"], options["--out"])
+    sys.exit(found is not None)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -2,10 +2,14 @@ import sys
 import os
 import socket
 import time
+
+START = time.perf_counter()
 import random
+import struct
+import zlib
 
 from enum import Enum
-from threading import Thread, Lock
+from threading import Thread
 from urllib import request
 
 os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"
@@ -13,15 +17,30 @@ os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"
 import pygame
 from pygame import Color, Rect
 
-from board import DisplayedBoard
+from board import DisplayedBoard, PACKED_SIZE
 from pieces import Kind, Piece
-from util import BOARD_SIZE, TIME, to_coords, format_time
-from ai import get_ai_move, get_ai_promotion
+from util import BOARD_SIZE, TIME, WORTHS, TOOLTIPS, to_coords, format_time
+from ai import AiProcess, get_ai_promotion
+from spectators import Spectators, SNAPSHOT, recv_exact
+from archive import GameRecord, save_game
+from perf import Metrics, TimedLock, TraceWriter
 
 PORT = 5398
+SPECTATOR_PORT = PORT + 1
+CLOCKS = struct.Struct("<?ii")  # Paused flag, white time and black time.
 BLACK = Color(0, 0, 0)
 WHITE = Color(255, 255, 255)
 SMOOTH = False
+CACHE_DIR = "cache"
+TIMING = "--timing" in sys.argv
+TRACE = "--trace" in sys.argv
+TRACE_FILE = "trace.json"
+PING = 3  # Network messages measuring the round trip, only sent while it is shown or traced.
+PONG = 4
+# A move from a square to itself without promotion, which peers without pings ignore as invalid.
+# Sent once on connecting, so that pings only go to peers that answer them instead of pausing.
+PINGS_SUPPORTED = bytes([0, 0, 0, 255])
+PING_INTERVAL = 2
 THEMES = {
     "Chess.com": {
         "background": Color("#333333"),
@@ -39,6 +58,20 @@ THEMES = {
 }
 
 
+def texture_path(side, kind):
+    return f"resources/{'white' if side == 1 else 'black'}/{kind.value}.png"
+
+
+def textures_version():
+    # Checksum of the modification times and sizes of the piece textures, naming the atlas built from them.
+    stamps = []
+    for kind in Kind:
+        for side in (1, 2):
+            stat = os.stat(texture_path(side, kind))
+            stamps.append(f"{stat.st_mtime_ns}:{stat.st_size}")
+    return zlib.crc32(" ".join(stamps).encode())
+
+
 class State(Enum):
     MAINMENU = 0
     HOSTMENU = 1
@@ -51,6 +84,7 @@ class Mode(Enum):
     LOCAL = "Play locally"
     HOST = "Host network game"
     JOIN = "Join network game"
+    WATCH = "Watch network game"
     CONTROLS = "Show Controls"
 
 class TextStyle(Enum):
@@ -69,19 +103,22 @@ class Game:
         # Configuration.
         self.mode = None
         self.size = BOARD_SIZE
-        self.theme = THEMES["Chess.com"]
+        self.theme_name = "Chess.com"
+        self.theme = THEMES[self.theme_name]
         self.padding = 20
         self.board = DisplayedBoard()
         self.board.setup_file("resources/default_moab.pos")
+        self.record = GameRecord(self.board)
+        self.record_slot = None
         self.side = None
         self.turn = 1
         self.paused = False
         self.result = None
-        self.showing_captured_piece = False
         
         # Ai.
         self.ai_plays_side_2 = False
         self.ai_found_move = None
+        self.ai = None
 
         # Window, event and drag state.
         pygame.display.set_caption("Fairy chess")
@@ -97,6 +134,22 @@ class Game:
         self.captures = []
         self.promotions = []
 
+        # Dirty rectangle rendering.
+        self.redraw = True
+        self.drawn_state = None
+        self.updated = []
+        self.drawn = {}
+        self.labels = []
+        self.drawn_labels = None
+        self.label_rects = []
+        self.drag_rect = None
+        self.board_layers = {}
+
+        # Performance overlay, toggled with F3.
+        self.metrics = Metrics(TraceWriter(TRACE_FILE) if TRACE else None)
+        self.show_hud = False
+        self.hud_rect = None
+
         # Menu tips.
         self.tip = 0
         self.tips = [
@@ -124,27 +177,13 @@ class Game:
         self.black_time = TIME
         self.last_second = time.time()
 
-        # Piece textures.
+        # Piece textures, loaded when first drawn.
         self.textures = {}
-        self.load_textures("resources/black")
-        self.load_textures("resources/white")
 
         # Tooltips.
         self.tooltip_piece = None
-        self.tooltips = dict()
-        with open("resources/tooltips.txt") as file:
-            content = [line[:-1] for line in file.readlines()]
-        i = 0
-        while i < len(content):
-            key = content[i]
-            worth = content[i+1]
-            tooltip = [f"{key} ({worth})" if worth != "0" else key]
-            i += 2
-            while i < len(content) and content[i] != "":
-                tooltip.append(content[i])
-                i += 1
-            self.tooltips[key] = tooltip
-            i += 1
+        self.tooltips = {key: [f"{key} ({WORTHS[key]})" if WORTHS[key] else key] + lines
+                         for key, lines in TOOLTIPS.items()}
 
         # Scale-dependent things.
         self.screen_rect: Rect = None
@@ -153,26 +192,72 @@ class Game:
         self.body_font = None
         self.tooltip_font = None
         self.scaled = {}
+        self.atlas_path = None
+        self.board_layer = None
+        self.promotion_marker = None
         self.resize()
 
-        # Sounds.
-        self.move_sound = pygame.mixer.Sound("resources/move.ogg")
-        self.capture_sound = pygame.mixer.Sound("resources/capture.ogg")
+        # Sounds, loaded when first played.
+        self.sounds = {}
 
         # Network communication.
         self.local_ip = socket.gethostbyname(socket.gethostname())
         self.public_ip = None
         self.peer_ip = ""
         self.socket = None
-        self.mutex = Lock()
-
-    def load_textures(self, dir):
-        for path, _, files in os.walk(dir):
-            for file in files:
-                filepath = os.path.join(path, file)
-                kind = Kind[os.path.splitext(file)[0].upper()]
-                side = 1 if "white" in path else 2
-                self.textures[(side, kind)] = pygame.image.load(filepath).convert_alpha()
+        self.spectators = None
+        self.spectating = False
+        self.mutex = TimedLock(self.metrics)
+        self.pings = {}
+        self.last_ping = 0
+        self.peer_pings = False
+
+        self.constructed = time.perf_counter()
+
+    def texture(self, side, kind):
+        if (side, kind) not in self.textures:
+            self.textures[side, kind] = pygame.image.load(texture_path(side, kind)).convert_alpha()
+        return self.textures[side, kind]
+
+    def sprite(self, side, kind):
+        # Scaled sprites come from the atlas of the current square size if one is cached on disk.
+        # Otherwise they are scaled one by one, and the atlas is written once all of them exist.
+        if (side, kind) not in self.scaled:
+            if not self.scaled and os.path.exists(self.atlas_path):
+                self.load_atlas()
+
+        if (side, kind) not in self.scaled:
+            f = pygame.transform.smoothscale if SMOOTH else pygame.transform.scale
+            self.scaled[side, kind] = f(self.texture(side, kind), self.square_rect.size)
+
+            if len(self.scaled) == 2 * len(Kind):
+                self.save_atlas()
+
+        return self.scaled[side, kind]
+
+    def load_atlas(self):
+        atlas = pygame.image.load(self.atlas_path).convert_alpha()
+        s = self.square_rect.width
+        for i, kind in enumerate(Kind):
+            for side in (1, 2):
+                self.scaled[side, kind] = atlas.subsurface(Rect(i * s, (side - 1) * s, s, s))
+
+    def save_atlas(self):
+        s = self.square_rect.width
+        atlas = pygame.Surface((len(Kind) * s, 2 * s), pygame.SRCALPHA)
+        for i, kind in enumerate(Kind):
+            for side in (1, 2):
+                sprite = self.scaled[side, kind]
+                sprite.set_alpha(255)
+                atlas.blit(sprite, (i * s, (side - 1) * s))
+
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        pygame.image.save(atlas, self.atlas_path)
+
+    def play(self, name):
+        if name not in self.sounds:
+            self.sounds[name] = pygame.mixer.Sound(f"resources/{name}.ogg")
+        self.sounds[name].play()
 
     def resize(self):
         # Determine the size of a screen-filling, slightly padded board with
@@ -211,13 +296,36 @@ class Game:
         self.square_rect.bottomleft = self.board_rect.bottomleft
 
         # Scaled piece textures.
-        f = pygame.transform.smoothscale if SMOOTH else pygame.transform.scale
-        self.scaled = {k: f(v, (s, s)) for k, v in self.textures.items()}
+        self.scaled = {}
+        self.atlas_path = os.path.join(CACHE_DIR, f"atlas_{s}{'_smooth' if SMOOTH else ''}_{textures_version():08x}.png")
+
+        # Static board layer with the square colors, cached per size and theme.
+        key = (s, self.theme_name)
+        if key not in self.board_layers:
+            layer = pygame.Surface((b, b))
+            for x in range(self.size):
+                for y in range(self.size):
+                    color = self.theme["white" if (x + y) % 2 else "black"]
+                    layer.fill(color, Rect(x * s, b - (y + 1) * s, s, s))
+            self.board_layers[key] = layer
+        self.board_layer = self.board_layers[key]
+
+        self.promotion_marker = pygame.Surface((s, s), pygame.SRCALPHA)
+        pygame.draw.circle(self.promotion_marker, self.theme["promotion"], (s // 2, s // 2), s // 4)
+        self.promotion_marker.set_alpha(180)
+        self.redraw = True
 
     def mainloop(self):
+        self.event = pygame.event.Event(pygame.NOEVENT)
+        self.refresh()
+        if TIMING:
+            print(f"Startup: {1000 * (self.constructed - START):.1f} ms until constructed, "
+                  f"{1000 * (time.perf_counter() - START):.1f} ms until first frame")
+
         while True:
             self.event = pygame.event.wait(50)
-            if self.event.type == pygame.NOEVENT and not self.dirty and self.last_second == int(time.time()):
+            thinking = self.ai is not None and self.ai.thinking
+            if self.event.type == pygame.NOEVENT and not self.dirty and not thinking and self.last_second == int(time.time()):
                 continue
 
             self.dirty = False
@@ -231,7 +339,11 @@ class Game:
             self.refresh()
 
     def refresh(self):
+        start = time.perf_counter()
         if self.event.type == pygame.QUIT:
+            if self.ai is not None:
+                self.ai.close()
+            self.metrics.close()
             sys.exit()
 
         if self.event.type == pygame.VIDEORESIZE:
@@ -245,31 +357,57 @@ class Game:
 
         if self.event.type == pygame.KEYDOWN and self.state == State.INGAME:
             # PRESS P TO PAUSE
-            if self.event.key == pygame.K_p and self.side in (None, self.turn):
+            if self.event.key == pygame.K_p and self.side in (None, self.turn) and not self.spectating:
                 self.pause()
+
+            # PRESS F3 TO SHOW THE PERFORMANCE OVERLAY
+            if self.event.key == pygame.K_F3:
+                self.show_hud = not self.show_hud
+                self.redraw = True
             
-            # HOLD LEFT ARROW TO SEE THE PREVIOUS BOARD STATE
-            if self.event.key == pygame.K_LEFT and self.side in (None, self.turn):
-                self.showing_captured_piece = True
+            # PRESS LEFT AND RIGHT ARROW TO STEP THROUGH THE MOVES, HOME AND END TO JUMP
+            if self.dragged is None and self.promoting is None:
+                self.mutex.acquire()
+                if self.event.key == pygame.K_LEFT:
+                    self.board.undo()
+                elif self.event.key == pygame.K_RIGHT:
+                    self.board.redo()
+                elif self.event.key == pygame.K_HOME:
+                    self.board.seek(0)
+                elif self.event.key == pygame.K_END:
+                    self.board.seek()
+                self.mutex.release()
 
             # PRESS CTRL+S TO SAVE THE BOARD STATE
             if self.event.key == pygame.K_s and pygame.key.get_mods() & pygame.KMOD_CTRL:
                 self.board.write_file("dump.pos")
+
+            # PRESS CTRL+R TO SAVE THE GAME RECORD TO THE ARCHIVE, OVERWRITING ITS EARLIER SAVE
+            if self.event.key == pygame.K_r and pygame.key.get_mods() & pygame.KMOD_CTRL:
+                self.record_slot = save_game("games.fca", self.record, self.record_slot)
             
             # PRESS A TO GIVE CONTROL OF THE BLACK PIECES TO THE AI
-            if self.event.key == pygame.K_a and self.side == None:
+            if self.event.key == pygame.K_a and self.side == None and not self.spectating:
                 if self.turn == 1:
                     self.ai_plays_side_2 = not self.ai_plays_side_2
                 elif not self.ai_plays_side_2:
                     self.ai_plays_side_2 = True
-                    Thread(target=self.find_ai_reply, daemon=True).start()
-        
-        # STOP HOLDING LEFT ARROW TO NO LONGER SEE THE PREVIOUS BOARD STATE            
-        if self.event.type == pygame.KEYUP and self.state == State.INGAME:
-            if self.event.key == pygame.K_LEFT:
-                self.showing_captured_piece = False
+                    self.find_ai_reply()
+
+        # Ingame, only changed parts of the screen are redrawn and passed to the display.
+        if self.state != State.INGAME or self.state != self.drawn_state or self.redraw:
+            self.surface.fill(self.theme["background"])
+            self.updated = [self.screen_rect]
+            self.drawn = {}
+            self.drawn_labels = None
+            self.label_rects = []
+            self.drag_rect = None
+            self.hud_rect = None
+            self.redraw = False
+        else:
+            self.updated = []
+        self.drawn_state = self.state
 
-        self.surface.fill(self.theme["background"])
         self.cursor = [self.screen_rect.centerx, self.screen_rect.height // 3]
 
         # PRESS ESCAPE TO RETURN TO MAIN MENU
@@ -280,6 +418,11 @@ class Game:
             elif self.state == State.CONTROLS:
                 self.state = State.MAINMENU
 
+            # CANCEL THE AI AND TAKE BACK CONTROL OF THE BLACK PIECES
+            elif self.state == State.INGAME and self.ai is not None and self.ai.thinking:
+                self.ai.cancel()
+                self.ai_plays_side_2 = False
+
         if self.state == State.MAINMENU:
             self.mainmenu()
 
@@ -299,7 +442,8 @@ class Game:
         elif self.state == State.CONTROLS:
             self.controls()
 
-        pygame.display.update()
+        pygame.display.update(self.updated)
+        self.metrics.frame(start, time.perf_counter())
 
     def mainmenu(self):
         self.text("Fairy chess", style=TextStyle.TITLE)
@@ -317,8 +461,9 @@ class Game:
                     Thread(target=self.lookup_public_ip, daemon=True).start()
                     Thread(target=self.netloop, daemon=True).start()
 
-                elif mode == Mode.JOIN:
+                elif mode in (Mode.JOIN, Mode.WATCH):
                     self.state = State.JOINMENU
+                    self.spectating = mode == Mode.WATCH
                     
                 elif mode == Mode.CONTROLS:
                     self.state = State.CONTROLS
@@ -356,7 +501,7 @@ class Game:
                 if value in "0123456789ABCDEF.:":
                     self.peer_ip += value
 
-        self.text("Joining game", style=TextStyle.TITLE)
+        self.text("Watching game" if self.spectating else "Joining game", style=TextStyle.TITLE)
         self.text("Please enter the IP you want to connect with or")
         self.text("simply click \"Connect\" to join a game hosted on this computer.")
         self.text(self.peer_ip)
@@ -366,7 +511,7 @@ class Game:
             self.state = State.CONNECTING
             if not self.peer_ip:
                 self.peer_ip = self.local_ip
-            Thread(target=self.netloop, daemon=True).start()
+            Thread(target=self.spectate if self.spectating else self.netloop, daemon=True).start()
 
     def connecting(self):
         self.text(f"Connecting with {self.peer_ip} " + self.dots(), pos=self.screen_rect.center)
@@ -375,10 +520,14 @@ class Game:
         self.text("Controls", style=TextStyle.TITLE)
         self.text("Move pieces via drag & drop using the left mouse button.")
         self.text("Inspect pieces by holding the right mouse button.")
-        self.text("Hold the left arrow key to see the state of the board before the most recent move.")
+        self.text("Use the arrow keys to step through the moves, and Home and End to jump.")
         self.text("Press P during your turn to pause the timers.")
+        self.text("Watch a hosted game by joining it as a spectator.")
         self.text("Press A during local play to give control of the black pieces to the computer.")
+        self.text("Press Esc while the computer is thinking to take back control.")
         self.text("Press CTRL+S to save the current position as a dump file.")
+        self.text("Press CTRL+R to append the moves of this game to the archive.")
+        self.text("Press F3 to show frame times, lock contention, AI speed and network delay.")
         self.text("Press Esc to return to the main menu.")
     
     def ingame(self):
@@ -393,40 +542,102 @@ class Game:
             self.last_second = int(now)
             self.dirty = True
 
+        # The overlay is drawn over the board, so the squares below it are drawn again first.
+        if self.hud_rect is not None:
+            self.surface.fill(self.theme["background"], self.hud_rect)
+            self.invalidate(self.hud_rect)
+            self.updated.append(self.hud_rect)
+            self.drawn_labels = None
+            self.hud_rect = None
+
+        # Erase the dragged piece from where it was drawn last time.
+        if self.drag_rect is not None:
+            self.surface.fill(self.theme["background"], self.drag_rect)
+            self.invalidate(self.drag_rect)
+            self.updated.append(self.drag_rect)
+            if not self.board_rect.contains(self.drag_rect):
+                self.drawn_labels = None
+            self.drag_rect = None
+
         self.infos()
 
         if not self.paused:
             self.mutex.acquire()
-            for sq in range(len(self.board.squares)):
-                self.square(sq)
+            self.board_input()
+            changed = self.draw_board()
             self.mutex.release()
-            if self.tooltip_piece or self.result is not None:
-                self.draw_tooltip()
+            if (self.tooltip_piece or self.result is not None) and changed:
+                self.updated.append(self.draw_tooltip())
 
         if self.promoting is not None:
-            self.promotion_popup()
+            self.updated.append(self.promotion_popup())
 
         if self.dragged:
             x, y = pygame.mouse.get_pos()
             x -= self.square_rect.width // 2
             y -= self.square_rect.height // 2
             self.piece(self.dragged, (x, y))
+            self.drag_rect = self.square_rect.move(x - self.square_rect.x, y - self.square_rect.y)
+            self.updated.append(self.drag_rect)
 
             if self.mouseup() and not self.board_rect.collidepoint(*pygame.mouse.get_pos()):
                 self.dragged = None
                 
+        if self.ai_plays_side_2 and self.ai is not None and self.ai_found_move is None:
+            self.ai_found_move = self.ai.poll()
+
         if self.ai_plays_side_2 and self.ai_found_move is not None:
-            from_sq, to_sq = self.ai_found_move
+            from_sq, to_sq, *promotion = self.ai_found_move
             self.ai_found_move = None
+            self.mutex.acquire()
             feedback = self.board.move(from_sq, to_sq)
-            self.handle_feedback(feedback, from_sq, to_sq)
-            
+            self.handle_feedback(feedback, from_sq, to_sq, promotion=promotion[0] if promotion else None)
+            self.mutex.release()
+
+        if self.ai is not None and self.ai.thinking:
+            self.metrics.ai(self.ai.nodes.value, self.ai.depth.value, time.perf_counter() - self.ai.started)
+
+        measured = self.show_hud or self.metrics.trace is not None
+        if measured and self.peer_pings and self.socket is not None and not self.spectating and now - self.last_ping >= PING_INTERVAL:
+            self.last_ping = now
+            sequence = int(now) % 256
+            self.pings[sequence] = time.perf_counter()
+            self.socket.send(bytes([PING, sequence, 0, 0]))
+
+        if self.show_hud:
+            self.hud_rect = self.draw_hud()
+            self.updated.append(self.hud_rect)
+
+    def draw_hud(self):
+        stats = self.metrics.summary()
+        round_trip = "-" if stats["round_trip"] is None else f"{1000 * stats['round_trip']:.0f} ms"
+        lines = [
+            f"Frame {1000 * stats['p50']:.1f} / {1000 * stats['p95']:.1f} / {1000 * stats['p99']:.1f} ms (p50 / p95 / p99)",
+            f"Refresh {stats['refreshes']:.0f} per second",
+            f"Mutex held {1000 * stats['held']:.0f} ms per second",
+            f"AI {stats['nodes_per_second']:.0f} nodes per second at depth {stats['depth']}",
+            f"Network round trip {round_trip}",
+        ]
+
+        bitmaps = [self.tooltip_font.render(line, True, self.theme["text"]) for line in lines]
+        padding = self.tooltip_font.get_height() // 2
+        rect = Rect(self.board_rect.topleft, (
+            max(bitmap.get_width() for bitmap in bitmaps) + 2 * padding,
+            sum(bitmap.get_height() for bitmap in bitmaps) + 2 * padding
+        ))
+        pygame.draw.rect(self.surface, self.theme["background"], rect)
+
+        y = rect.top + padding
+        for bitmap in bitmaps:
+            self.surface.blit(bitmap, (rect.left + padding, y))
+            y += bitmap.get_height()
+        return rect
 
     def infos(self):
         is_white = self.side is None or self.side == 1
 
-        clock_rect1 = self.text(format_time(self.black_time if is_white else self.white_time), pos=(20, 20), align=(-1, -1))
-        clock_rect2 = self.text(format_time(self.white_time if is_white else self.black_time), pos=(20, self.screen_rect.height - 20), align=(-1, 1))
+        clock_rect1 = self.label(format_time(self.black_time if is_white else self.white_time), pos=(20, 20), align=(-1, -1))
+        clock_rect2 = self.label(format_time(self.white_time if is_white else self.black_time), pos=(20, self.screen_rect.height - 20), align=(-1, 1))
 
         side_1_worth, side_2_worth = self.board.get_worths()
         if is_white:
@@ -440,16 +651,88 @@ class Game:
         their_worth_theme = "disadvantage" if self.ai_plays_side_2 else "text"
         
         if self.board_rect.left < clock_rect1.right:
-            self.text(f"[{their_worth}]", pos=(self.screen_rect.w - 20, 20), align=(1, -1), theme=their_worth_theme)
-            self.text(f"[{my_worth}]", pos=(self.screen_rect.w - 20, clock_rect2.top), align=(1, -1))
-            self.text(diff_text, pos=(self.screen_rect.centerx, clock_rect2.top), align=(0, -1), theme=theme)
+            self.label(f"[{their_worth}]", pos=(self.screen_rect.w - 20, 20), align=(1, -1), theme=their_worth_theme)
+            self.label(f"[{my_worth}]", pos=(self.screen_rect.w - 20, clock_rect2.top), align=(1, -1))
+            self.label(diff_text, pos=(self.screen_rect.centerx, clock_rect2.top), align=(0, -1), theme=theme)
         else:
-            self.text(f"[{their_worth}]", pos=(20, clock_rect1.bottom + 20), align=(-1, -1), theme=their_worth_theme)
-            self.text(f"[{my_worth}]", pos=(20, clock_rect2.top - 20), align=(-1, 1))
+            self.label(f"[{their_worth}]", pos=(20, clock_rect1.bottom + 20), align=(-1, -1), theme=their_worth_theme)
+            self.label(f"[{my_worth}]", pos=(20, clock_rect2.top - 20), align=(-1, 1))
             diff = my_worth - their_worth
-            self.text(diff_text, pos=(20, self.screen_rect.centery), align=(-1, 0), theme=theme)
+            self.label(diff_text, pos=(20, self.screen_rect.centery), align=(-1, 0), theme=theme)
+
+        # Only redraw the labels when one of them changed.
+        if self.labels != self.drawn_labels:
+            for rect in self.label_rects:
+                self.surface.fill(self.theme["background"], rect)
+                self.invalidate(rect)
+            self.updated.extend(self.label_rects)
 
-    def square(self, sq):
+            self.label_rects = [self.text(*label[:2], align=label[2], theme=label[3]) for label in self.labels]
+            self.updated.extend(self.label_rects)
+            self.drawn_labels = self.labels
+        self.labels = []
+
+    def label(self, text, pos, align=(0, 0), theme="text"):
+        self.labels.append((text, pos, align, theme))
+        return self.text(text, pos=pos, align=align, draw=False)
+
+    def board_input(self):
+        pos = pygame.mouse.get_pos()
+
+        # Releases are handled before the bounds check, so that the tooltip closes wherever the button is let go.
+        if self.right_mouseup() and self.tooltip_piece:
+            self.tooltip_piece = None
+            self.redraw = True
+
+        if self.promoting is not None or not self.board_rect.collidepoint(*pos):
+            return
+
+        x = (pos[0] - self.board_rect.left) // self.square_rect.width
+        y = (self.board_rect.bottom - 1 - pos[1]) // self.square_rect.height
+        sq = to_square((x, y))
+        if self.side == 2:
+            sq = 255 - sq
+
+        if self.right_mousedown():
+            piece = self.board.squares[sq]
+            if piece:
+                self.tooltip_piece = piece
+                self.redraw = True
+
+        if self.mousedown():
+            piece = self.board.squares[sq]
+            if piece and not self.spectating and not self.board.reviewing and ((self.side is None and not (piece.side == 2 and self.ai_plays_side_2)) or piece.side == self.side):
+                self.dragged = piece
+                self.moves, self.captures = self.board.legal_moves(sq)
+                self.promotions = piece.promotion_squares()
+
+        elif self.dragged and self.mouseup():
+            from_sq = self.dragged.square
+            feedback = self.board.move(from_sq, sq)
+            self.handle_feedback(feedback, from_sq, sq)
+            self.dragged = None
+
+    def screen_square(self, sq):
+        x, y = to_coords(255 - sq if self.side == 2 else sq)
+        return self.square_rect.move(x * self.square_rect.width, -y * self.square_rect.height)
+
+    def invalidate(self, rect):
+        for sq in list(self.drawn):
+            if self.screen_square(sq).colliderect(rect):
+                del self.drawn[sq]
+
+    def draw_board(self):
+        # Draws the squares whose appearance differs from the last drawn frame.
+        changed = False
+        for sq in range(len(self.board.squares)):
+            look = self.square_look(sq)
+            if self.drawn.get(sq) != look:
+                self.drawn[sq] = look
+                self.updated.append(self.draw_square(sq, look))
+                changed = True
+        return changed
+
+    def square_look(self, sq):
         x, y = to_coords(255 - sq if self.side == 2 else sq)
 
         if self.dragged and sq in self.moves:
@@ -463,56 +746,28 @@ class Game:
         else:
             key = "black"
 
-        square = self.square_rect.move(x * self.square_rect.width, -y * self.square_rect.height)
-        pygame.draw.rect(self.surface, self.theme[key], square)
-
-        if self.promoting is None and square.collidepoint(*pygame.mouse.get_pos()):
-            if self.right_mousedown():
-                piece = self.board.squares[sq]
-                if piece:
-                    self.tooltip_piece = piece
-
-            elif self.right_mouseup():
-                self.tooltip_piece = None
-
-            if self.mousedown():
-                piece = self.board.squares[sq]
-                if piece and ((self.side is None and not (piece.side == 2 and self.ai_plays_side_2)) or piece.side == self.side):
-                    self.dragged = piece
-                    self.moves, self.captures = piece.move_and_capture_squares(self.board, check_side=True)
-                    self.promotions = piece.promotion_squares()
-
-            elif self.dragged and self.mouseup():
-                from_sq = self.dragged.square
-                feedback = self.board.move(from_sq, sq)
-                self.handle_feedback(feedback, from_sq, sq)
-                self.dragged = None
+        shown = None
+        piece = self.board.squares[sq]
+        if piece and piece != self.dragged:
+            shown = piece.side, piece.kind
 
-        if key == "last_squares" and self.showing_captured_piece:
-                    
-            if sq == self.board.highlighted_squares[0]:
-                new_piece = Piece(3 - self.turn, self.board.squares[self.board.highlighted_squares[1]].kind, sq)
-                self.piece(new_piece, square.topleft)
-                
-            elif sq == self.board.highlighted_squares[-1]:
-                if self.board.captured_kind is not None:
-                    new_piece = Piece(self.turn, self.board.captured_kind, sq)
-                    self.piece(new_piece, square.topleft)
+        return key, shown, bool(self.dragged) and sq in self.promotions
+
+    def draw_square(self, sq, look):
+        key, shown, promotion = look
+        square = self.screen_square(sq)
+
+        if key in ("white", "black"):
+            self.surface.blit(self.board_layer, square, square.move(-self.board_rect.x, -self.board_rect.y))
         else:
-            piece = self.board.squares[sq]
-            if piece and piece != self.dragged:
-                self.piece(piece, square.topleft)
-
-        if self.dragged and sq in self.promotions:
-            temp = pygame.Surface(self.square_rect.size, pygame.SRCALPHA)
-            pygame.draw.circle(
-                temp,
-                self.theme["promotion"],
-                (self.square_rect.width // 2, self.square_rect.height // 2),
-                self.square_rect.width // 4,
-            )
-            temp.set_alpha(180)
-            self.surface.blit(temp, square)
+            pygame.draw.rect(self.surface, self.theme[key], square)
+
+        if shown is not None:
+            self.piece(Piece(*shown, sq), square.topleft)
+
+        if promotion:
+            self.surface.blit(self.promotion_marker, square)
+        return square
 
     def promotion_popup(self):
         from_sq, to_sq, choices = self.promoting
@@ -533,15 +788,19 @@ class Game:
             if square.collidepoint(*pygame.mouse.get_pos()):
                 alpha = 150 if self.pressed else 200
                 if self.mouseup():
+                    self.mutex.acquire()
                     feedback = self.board.promote(to_sq, choice), None
                     self.handle_feedback(feedback, from_sq, to_sq, promotion=choice)
+                    self.mutex.release()
 
             self.piece(Piece(self.turn, choice), square, alpha)
             square.x += self.square_rect.width
 
+        return popup
+
     def piece(self, piece, pos, alpha=255):
         try:
-            bitmap = self.scaled[piece.side, piece.kind]
+            bitmap = self.sprite(piece.side, piece.kind)
             bitmap.set_alpha(alpha)
             self.surface.blit(bitmap, pos)
         except KeyError:
@@ -619,25 +878,81 @@ class Game:
             self.socket.listen(1)
             self.socket, (self.peer_ip, _) = self.socket.accept()
             self.socket.send(bytes([3 - self.side]))
+            self.spectators = Spectators(self.local_ip, SPECTATOR_PORT, self.snapshot, self.mutex)
 
         print(f"Connected to {self.peer_ip}")
+        self.peer_pings = False
+        self.socket.send(PINGS_SUPPORTED)
         self.state = State.INGAME
         self.last_second = time.time()
         self.dirty = True
 
         while True:
-            pause, from_sq, to_sq, promotion = self.socket.recv(4)
-            if pause == 0:
+            message = recv_exact(self.socket, 4)
+            pause, from_sq, to_sq, promotion = message
+            if message == PINGS_SUPPORTED:
+                self.peer_pings = True
+            elif pause == PING:
+                self.socket.send(bytes([PONG, from_sq, 0, 0]))
+            elif pause == PONG:
+                if from_sq in self.pings:
+                    self.metrics.network(time.perf_counter() - self.pings.pop(from_sq))
+            elif pause == 0:
                 self.mutex.acquire()
                 feedback = self.board.move(from_sq, to_sq)
-                if promotion < len(Kind):
-                    feedback = self.board.promote(to_sq, list(Kind)[promotion]), feedback[1]
-                self.handle_feedback(feedback, from_sq, to_sq, own=False)
+                promotion = list(Kind)[promotion] if promotion < len(Kind) else None
+                if promotion is not None:
+                    feedback = self.board.promote(to_sq, promotion), feedback[1]
+                self.handle_feedback(feedback, from_sq, to_sq, promotion=promotion, own=False)
                 self.mutex.release()
             else:
                 self.pause(send=False)
             self.dirty = True
 
+    def spectate(self):
+        print(f"Watching {self.peer_ip}")
+        self.socket = socket.create_connection((self.peer_ip, SPECTATOR_PORT))
+
+        while True:
+            pause, from_sq, to_sq, promotion = recv_exact(self.socket, 4)
+            if pause not in (0, SNAPSHOT):
+                self.pause(send=False)
+                self.dirty = True
+                continue
+
+            self.mutex.acquire()
+            if pause == SNAPSHOT:
+                self.load_snapshot(recv_exact(self.socket, PACKED_SIZE + CLOCKS.size))
+                self.state = State.INGAME
+            elif pause == 0:
+                feedback = self.board.move(from_sq, to_sq)
+                promotion = list(Kind)[promotion] if promotion < len(Kind) else None
+                if promotion is not None:
+                    feedback = self.board.promote(to_sq, promotion), feedback[1]
+                self.handle_feedback(feedback, from_sq, to_sq, promotion=promotion, own=False)
+            self.mutex.release()
+            self.dirty = True
+
+    def snapshot(self):
+        # Watchers always get the current position, even while the host reviews earlier moves.
+        # A move waiting for its promotion choice is left out, and reaches them as a delta once chosen.
+        ply = self.board.history.ply
+        self.board.seek()
+        data = self.board.pack_settled()
+        self.board.seek(ply)
+        return data + CLOCKS.pack(self.paused, self.white_time, self.black_time)
+
+    def load_snapshot(self, data):
+        self.board.unpack(data)
+        self.record = GameRecord(self.board)
+        self.record_slot = None
+        self.paused, self.white_time, self.black_time = CLOCKS.unpack_from(data, PACKED_SIZE)
+        self.turn = self.board.turn
+        self.result = None
+        self.promoting = None
+        self.last_second = time.time()
+        self.redraw = True
+
     def handle_feedback(self, feedback, from_sq, to_sq, promotion=None, own=True):
         result, mocap = feedback
         if result == "Invalid":
@@ -645,39 +960,52 @@ class Game:
         
         if result == "Stalemate":
             self.result = result + "."
+            self.redraw = True
 
         if result == "Checkmate":
             side = "White" if self.turn == 1 else "Black"
             self.result = f"Checkmate. {side} wins."
+            self.redraw = True
 
         if mocap == "Move":
-            self.move_sound.play()
+            self.play("move")
         elif mocap == "Capture":
-            self.capture_sound.play()
+            self.play("capture")
 
         if own and type(result) == list:
             if self.side == None and self.turn == 2 and self.ai_plays_side_2:
-                self.find_ai_promotion(from_sq, to_sq, result)
+                self.find_ai_promotion(from_sq, to_sq, result, promotion)
             else:
                 self.promoting = from_sq, to_sq, result
+                self.redraw = True
             return
 
+        self.record.add(from_sq, to_sq, promotion, self.white_time if self.turn == 1 else self.black_time)
         self.turn = 3 - self.turn
-        self.promoting = None
-        self.showing_captured_piece = False
+        if self.promoting is not None:
+            self.promoting = None
+            self.redraw = True
 
+        promotion = len(Kind) if promotion is None else list(Kind).index(promotion)
+        delta = bytes([0, from_sq, to_sq, promotion])
         if own and self.socket is not None:
-            promotion = len(Kind) if promotion is None else list(Kind).index(promotion)
-            self.socket.send(bytes([0, from_sq, to_sq, promotion]))
+            self.socket.send(delta)
+        if self.spectators is not None:
+            self.spectators.broadcast(delta)
             
         if self.turn == 2 and self.ai_plays_side_2 and result == "Valid":
-            Thread(target=self.find_ai_reply, daemon=True).start()          
-            
+            self.find_ai_reply()
+
     def find_ai_reply(self):
-        self.ai_found_move = get_ai_move(self.board)
+        if self.ai is None:
+            self.ai = AiProcess()
+        self.board.seek()
+        self.ai.start(self.board)
     
-    def find_ai_promotion(self, from_sq, to_sq, kinds):
-        choice = get_ai_promotion(self.board, to_sq, kinds)
+    def find_ai_promotion(self, from_sq, to_sq, kinds, choice=None):
+        # The search names the kind with the move where there is a choice.
+        if choice is None:
+            choice = get_ai_promotion(self.board, to_sq, kinds)
         feedback = self.board.promote(to_sq, choice), None
         self.handle_feedback(feedback, from_sq, to_sq, promotion=choice)
 
@@ -688,10 +1016,22 @@ class Game:
         return (1 + int(time.time()) % 3) * "."
 
     def pause(self, send=True):
-        self.dragged = None
-        self.paused = not self.paused
-        if self.socket is not None and send:
-            self.socket.send(bytes([1, 0, 0, 0]))
+        # Under the mutex, so that a joining watcher's snapshot agrees with the broadcast toggle.
+        with self.mutex:
+            self.dragged = None
+            self.paused = not self.paused
+            self.redraw = True
+
+            # The AI stops thinking while paused and starts over afterwards.
+            if self.ai is not None and self.ai_plays_side_2 and self.turn == 2:
+                if self.paused:
+                    self.ai.cancel()
+                else:
+                    self.find_ai_reply()
+            if self.socket is not None and send:
+                self.socket.send(bytes([1, 0, 0, 0]))
+            if self.spectators is not None:
+                self.spectators.broadcast(bytes([1, 0, 0, 0]))
 
     def draw_tooltip(self):
         lines = []
@@ -713,6 +1053,8 @@ class Game:
             y = self.screen_rect.centery - ((len(lines) - 0.7) * line_height // 2) + i * line_height
             self.text(line, pos=(x, y), style=TextStyle.TOOLTIP)
 
+        return tooltip
+
 
 if __name__ == "__main__":
     Game().mainloop()
@@ -0,0 +1,151 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+WINDOW = 1.0          # Seconds over which rates and lock hold times are measured.
+FRAME_SAMPLES = 600   # Number of recent frames the percentiles are taken from.
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class TraceWriter:
+    """
+    Writes events in the Chrome trace-event format, to be opened in chrome://tracing or Perfetto.
+    The array format does not need its closing bracket, so a trace cut short by a crash stays readable.
+    """
+
+    def __init__(self, filename):
+        self.file = open(filename, "w")
+        self.file.write("[")
+        self.lock = threading.Lock()
+        self.first = True
+        self.start = time.perf_counter()
+        self.pid = os.getpid()
+
+    def timestamp(self, t):
+        return round(1e6 * (t - self.start), 1)
+
+    def write(self, event):
+        with self.lock:
+            self.file.write(("\n" if self.first else ",\n") + json.dumps(event))
+            self.first = False
+
+    def complete(self, name, start, end, category="ui", args=None):
+        event = {"name": name, "cat": category, "ph": "X", "ts": self.timestamp(start),
+                 "dur": round(1e6 * (end - start), 1), "pid": self.pid, "tid": threading.get_ident()}
+        if args:
+            event["args"] = args
+        self.write(event)
+
+    def counter(self, name, values, t):
+        self.write({"name": name, "ph": "C", "ts": self.timestamp(t), "pid": self.pid, "args": values})
+
+    def close(self):
+        with self.lock:
+            self.file.write("\n]\n")
+            self.file.close()
+
+
+class Metrics:
+    def __init__(self, trace=None):
+        self.trace = trace
+        self.lock = threading.Lock()
+        self.frames = deque(maxlen=FRAME_SAMPLES)
+        self.refreshes = deque()
+        self.holds = deque()
+        self.round_trip = None
+        self.nodes = 0
+        self.depth = 0
+        self.nodes_per_second = 0
+
+    def expire(self, samples, now):
+        while samples and samples[0][0] < now - WINDOW:
+            samples.popleft()
+
+    def frame(self, start, end):
+        with self.lock:
+            self.frames.append(end - start)
+            self.refreshes.append((end, end - start))
+            self.expire(self.refreshes, end)
+        if self.trace is not None:
+            self.trace.complete("refresh", start, end)
+
+    def hold(self, name, start, end):
+        # Called from whichever thread released the lock.
+        with self.lock:
+            self.holds.append((end, end - start))
+            self.expire(self.holds, end)
+        if self.trace is not None:
+            self.trace.complete(name, start, end, category="lock")
+
+    def network(self, round_trip):
+        self.round_trip = round_trip
+        if self.trace is not None:
+            self.trace.counter("network", {"round trip ms": 1000 * round_trip}, time.perf_counter())
+
+    def ai(self, nodes, depth, elapsed):
+        self.nodes = nodes
+        self.depth = depth
+        self.nodes_per_second = nodes / elapsed if elapsed > 0 else 0
+        if self.trace is not None:
+            self.trace.counter("ai", {"nodes per second": round(self.nodes_per_second), "depth": depth}, time.perf_counter())
+
+    def summary(self):
+        now = time.perf_counter()
+        with self.lock:
+            self.expire(self.refreshes, now)
+            self.expire(self.holds, now)
+            frames = list(self.frames)
+            refreshes = len(self.refreshes)
+            held = sum(duration for _, duration in self.holds)
+
+        return {
+            "p50": percentile(frames, 0.5),
+            "p95": percentile(frames, 0.95),
+            "p99": percentile(frames, 0.99),
+            "refreshes": refreshes / WINDOW,
+            "held": held / WINDOW,
+            "round_trip": self.round_trip,
+            "nodes_per_second": self.nodes_per_second,
+            "depth": self.depth,
+        }
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+
+class TimedLock:
+    """A Lock that reports how long it was held to the metrics."""
+
+    def __init__(self, metrics, name="mutex"):
+        self.lock = threading.Lock()
+        self.metrics = metrics
+        self.name = name
+        self.acquired = 0
+
+    def acquire(self, *args):
+        result = self.lock.acquire(*args)
+        if result:
+            self.acquired = time.perf_counter()
+        return result
+
+    def release(self):
+        acquired = self.acquired
+        self.lock.release()
+        self.metrics.hold(self.name, acquired, time.perf_counter())
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
@@ -0,0 +1,142 @@
+import select
+import socket
+from collections import deque
+from threading import Thread, Lock
+
+SNAPSHOT = 2        # First byte of a 4-byte header announcing a full snapshot.
+MAX_BUFFER = 4096   # Spectators lagging further behind are resynced with a fresh snapshot.
+
+
+def recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return data
+
+
+class Outbox:
+    """Bytes queued for one watcher, keeping track of where each message starts."""
+
+    def __init__(self, message):
+        self.data = bytearray(message)
+        self.lengths = deque([len(message)])
+        self.sent = 0  # Bytes of the first message already sent.
+
+    def __len__(self):
+        return len(self.data)
+
+    def push(self, message):
+        self.data += message
+        self.lengths.append(len(message))
+
+    def replace(self, message):
+        # Replaces every unsent message. A message that is partly sent has to be finished first.
+        if self.sent:
+            first = self.lengths[0]
+            del self.data[first - self.sent:]
+            self.lengths = deque([first])
+        else:
+            self.data.clear()
+            self.lengths.clear()
+        self.push(message)
+
+    def consume(self, count):
+        del self.data[:count]
+        self.sent += count
+        while self.lengths and self.sent >= self.lengths[0]:
+            self.sent -= self.lengths.popleft()
+
+
+class Spectators:
+    """
+    Fans the 4-byte move deltas of a game out to any number of watchers.
+    A new watcher first receives one snapshot, which snapshot() produces while mutex is held.
+    """
+
+    def __init__(self, host, port, snapshot, mutex):
+        self.snapshot = snapshot
+        self.mutex = mutex
+        self.lock = Lock()
+        self.buffers = {}
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen()
+        self.wakeup, self.waker = socket.socketpair()
+
+        Thread(target=self.loop, daemon=True).start()
+
+    def message(self):
+        return bytes([SNAPSHOT, 0, 0, 0]) + self.snapshot()
+
+    def broadcast(self, delta):
+        # Must be called with the game mutex held, so that a resync snapshot matches the delta stream.
+        with self.lock:
+            if not self.buffers:
+                return
+
+            resync = None
+            for buffer in self.buffers.values():
+                if len(buffer) + len(delta) > MAX_BUFFER:
+                    if resync is None:
+                        resync = self.message()
+                    buffer.replace(resync)
+                else:
+                    buffer.push(delta)
+
+        self.waker.send(b"\0")
+
+    def drop(self, client):
+        with self.lock:
+            self.buffers.pop(client, None)
+        client.close()
+
+    def loop(self):
+        while True:
+            with self.lock:
+                clients = list(self.buffers)
+                pending = [client for client in clients if self.buffers[client]]
+
+            readable, writable, _ = select.select([self.server, self.wakeup] + clients, pending, [])
+
+            for sock in readable:
+                if sock is self.server:
+                    client, _ = self.server.accept()
+                    client.setblocking(False)
+                    with self.mutex:
+                        message = self.message()
+                        with self.lock:
+                            self.buffers[client] = Outbox(message)
+
+                elif sock is self.wakeup:
+                    self.wakeup.recv(4096)
+
+                else:
+                    # Watchers never send anything, so this is either a disconnect or garbage.
+                    try:
+                        closed = not sock.recv(4096)
+                    except OSError:
+                        closed = True
+                    if closed:
+                        self.drop(sock)
+
+            for client in writable:
+                with self.lock:
+                    buffer = self.buffers.get(client)
+                    if not buffer:
+                        continue
+                    try:
+                        sent = client.send(buffer.data)
+                    except BlockingIOError:
+                        continue
+                    except OSError:
+                        sent = None
+                    else:
+                        buffer.consume(sent)
+
+                if sent is None:
+                    self.drop(client)
@@ -0,0 +1,184 @@
+"""
+Tactical test suite measuring how deep, how many nodes and how long the search needs to find known winning moves.
+
+    python suite.py [file.suite] [--depth n] [--time seconds] [--nodes n] [--out results.json] [--compare results.json]
+
+Each line of a suite names a test, a .pos position relative to the suite file, the side to move,
+optionally moves played first (which sets up en passant), and after "bm" the moves that solve it:
+
+    bull_fork  bull_fork.pos  2  bm k12i9
+
+Every test runs AiMemoryBoard.think by iterative deepening under the depth, time and node limits, as
+engine.py does for "go", so the transposition table and the selective search are measured too. A test
+is solved when the best move of the last completed depth is one of the solving moves. It counts as found
+at the first depth from which on the best move stayed one of them, and the nodes and time-to-solve are
+those searched by the end of that depth. Each test is also played by get_ai_move, the path the game
+uses, under the depth and time limits. Results are written as JSON with --out, and --compare prints
+them next to the results of another build.
+"""
+
+import contextlib
+import json
+import os
+import sys
+import time
+
+from ai import AiMemoryBoard, get_ai_move
+from engine import format_move, load_position, parse_move
+from perf import percentile
+
+SUITE = "resources/tactics/fairy.suite"
+DEPTH_LIMIT = 4
+TIME_LIMIT = 30  # Seconds per search, each test searches twice.
+
+
+class Test:
+    def __init__(self, name, position, turn, moves, best):
+        self.name = name
+        self.position = position
+        self.turn = turn
+        self.moves = moves
+        self.best = best
+
+    def load(self):
+        return load_position(self.position, self.turn, self.moves)
+
+    def board(self):
+        board = AiMemoryBoard(self.turn)
+        board.get_setup_from_board(self.load())
+        return board
+
+
+def load_suite(filename):
+    tests = []
+    directory = os.path.dirname(filename)
+    with open(filename) as file:
+        for number, line in enumerate(file, 1):
+            words = line.split("#")[0].split()
+            if not words:
+                continue
+            if len(words) < 5 or "bm" not in words:
+                raise ValueError(f"{filename}:{number}: expected a name, position, side to move and bm")
+
+            name, position, turn = words[:3]
+            split = words.index("bm")
+            played = words[3:split]
+            if played and played[0] != "moves":
+                raise ValueError(f"{filename}:{number}: unexpected {played[0]}")
+            moves = [parse_move(move) for move in played[1:]]
+            best = {format_move(parse_move(move)) for move in words[split + 1:]}
+            tests.append(Test(name, os.path.join(directory, position), int(turn), moves, best))
+    return tests
+
+
+def run_test(test, depth=DEPTH_LIMIT, seconds=TIME_LIMIT, nodes=None):
+    board = test.board()
+    start = time.perf_counter()
+
+    def should_stop():
+        if nodes is not None and board.nodes >= nodes:
+            return True
+        return seconds is not None and time.perf_counter() - start >= seconds
+
+    found = None
+    completed = 0
+
+    def report(reached, results):
+        nonlocal found, completed
+        completed = reached
+        if format_move(results[0][1]) not in test.best:
+            found = None
+        elif found is None:
+            found = reached, board.nodes, time.perf_counter() - start
+
+    board.should_stop = should_stop
+    results = board.think(depth, report=report)
+    elapsed = time.perf_counter() - start
+
+    # Unsolved tests report everything that was searched.
+    solved_depth, solved_nodes, solved_time = found or (completed, board.nodes, elapsed)
+
+    # The game's AI prints the move it decides on.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        played = get_ai_move(test.load(), seconds=float("inf") if seconds is None else seconds, max_depth=depth)
+    played = None if played is None else format_move(played)
+
+    return {
+        "move": format_move(results[0][1]) if results else None,
+        "solved": found is not None,
+        "depth": solved_depth,
+        "nodes": solved_nodes,
+        "time": round(solved_time, 4),
+        "played": played,
+        "played_solved": played in test.best,
+    }
+
+
+def summary(results):
+    solved = [result for result in results.values() if result["solved"]]
+    times = [result["time"] for result in solved]
+    depths = [result["depth"] for result in solved]
+    played = sum(result["played_solved"] for result in results.values())
+    return (f"Solved {len(solved)}/{len(results)}, median depth {percentile(depths, 0.5)}, "
+            f"median time-to-solve {percentile(times, 0.5):.3f}s, played by the game AI {played}/{len(results)}")
+
+
+def compare(results, other):
+    for name, result in results.items():
+        if name not in other:
+            continue
+        before = other[name]
+        change = ""
+        if result["solved"] and not before["solved"]:
+            change = "  now solved"
+        elif before["solved"] and not result["solved"]:
+            change = "  no longer solved"
+        if before["played_solved"] != result["played_solved"]:
+            change += "  now played" if result["played_solved"] else "  no longer played"
+        print(f"{name:<24} depth {before['depth']:2} -> {result['depth']:2} {before['nodes']:8} -> {result['nodes']:8} nodes "
+              f"{before['time']:8.3f}s -> {result['time']:8.3f}s{change}")
+    print(f"Before: {summary(other)}")
+    print(f"After:  {summary(results)}")
+
+
+def run_suite(filename=SUITE, depth=DEPTH_LIMIT, seconds=TIME_LIMIT, nodes=None):
+    results = dict()
+    for test in load_suite(filename):
+        result = run_test(test, depth, seconds, nodes)
+        results[test.name] = result
+        print(f"{test.name:<24} {'solved' if result['solved'] else 'FAILED':<6} {result['move'] or '-':<16} "
+              f"depth {result['depth']:2} {result['nodes']:8} nodes {result['time']:8.3f}s  "
+              f"game {'played' if result['played_solved'] else 'FAILED'} {result['played'] or '-'}")
+    print(summary(results))
+    return results
+
+
+def main(args):
+    filename = SUITE
+    options = {"--depth": DEPTH_LIMIT, "--time": TIME_LIMIT, "--nodes": None, "--out": None, "--compare": None}
+    i = 0
+    while i < len(args):
+        if args[i] in options:
+            options[args[i]] = args[i + 1] if args[i] in ("--out", "--compare") else float(args[i + 1])
+            i += 2
+        else:
+            filename = args[i]
+            i += 1
+
+    depth = int(options["--depth"])
+    nodes = None if options["--nodes"] is None else int(options["--nodes"])
+    results = run_suite(filename, depth, options["--time"], nodes)
+
+    if options["--out"] is not None:
+        with open(options["--out"], "w") as file:
+            limits = {"depth": depth, "time": options["--time"], "nodes": nodes}
+            json.dump({"suite": filename, **limits, "results": results}, file, indent=1)
+    if options["--compare"] is not None:
+        with open(options["--compare"]) as file:
+            compare(results, json.load(file)["results"])
+
+    sys.exit(not all(result["solved"] and result["played_solved"] for result in results.values()))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,412 @@
+"""
+Endgame tablebases for a few pieces besides the two kings, generated by retrograde analysis.
+
+A table stores one byte per position: 0 for a draw, 255 for an illegal or non-canonical
+index, otherwise 1 + the distance to mate in plies. Odd distances are wins for the side
+to move, even distances losses. All kinds in a table move the same way for both sides and
+in every direction, so positions are reduced by the 8 symmetries of the square and the
+colors can be swapped when probing.
+
+    python tablebase.py [--pieces 3|4] Unicorn Lion ...
+
+generates every table with up to the given number of pieces from the named kinds.
+Three piece tables take 4.7 MB each. Four piece tables take 1.2 GB each, and generating
+them in Python takes days.
+"""
+
+import itertools
+import mmap
+import os
+import sys
+from array import array
+from collections import defaultdict
+
+from board import Board, KINDS
+from pieces import Kind, Piece
+from util import BOARD_SIZE, CAPTURES, QUIETS, to_coords, to_square
+
+TABLEBASE_DIR = "tablebases"
+MAX_PIECES = 4
+ILLEGAL = 255
+ESCAPE = 0xFFFF  # Counter of positions that can reach a draw or win by capturing.
+
+# Kinds that promote or only move forward are not symmetric, so they have no tables.
+TABLEBASE_KINDS = [kind for kind in Kind if kind not in (
+    Kind.KING, Kind.PAWN, Kind.CENTURION, Kind.BUFFOON, Kind.SHIP
+)]
+UNRETRACEABLE_KINDS = (Kind.RHINOCEROS, Kind.GRYPHON)  # They cannot retrace their path, so un-moves are searched.
+
+
+def _transform(sq, mirror_x, mirror_y, transpose):
+    x, y = to_coords(sq)
+    if transpose:
+        x, y = y, x
+    if mirror_x:
+        x = BOARD_SIZE - 1 - x
+    if mirror_y:
+        y = BOARD_SIZE - 1 - y
+    return to_square((x, y))
+
+
+TRANSFORMS = [[_transform(sq, *flags) for sq in range(BOARD_SIZE ** 2)]
+              for flags in itertools.product((False, True), repeat=3)]
+HALF = BOARD_SIZE // 2
+TRIANGLE_SQUARES = [to_square((x, y)) for y in range(HALF) for x in range(y + 1)]
+TRIANGLE = {sq: i for i, sq in enumerate(TRIANGLE_SQUARES)}
+
+
+def sort_kinds(kinds):
+    return tuple(sorted(kinds, key=KINDS.index))
+
+
+def swapped(white, black):
+    # Tables are stored with the stronger material as white.
+    return (len(black), [KINDS.index(kind) for kind in sort_kinds(black)]) > \
+        (len(white), [KINDS.index(kind) for kind in sort_kinds(white)])
+
+
+def material(white, black):
+    if swapped(white, black):
+        white, black = black, white
+    return sort_kinds(white), sort_kinds(black)
+
+
+class Tablebase:
+    def __init__(self, white, black, values=None):
+        self.white = sort_kinds(white)
+        self.black = sort_kinds(black)
+        self.kinds = (Kind.KING, Kind.KING) + self.white + self.black
+        self.sides = (1, 2) + (1,) * len(self.white) + (2,) * len(self.black)
+        self.count = len(self.kinds)
+        self.size = 2 * len(TRIANGLE) * (BOARD_SIZE ** 2) ** (self.count - 1)
+        self.values = values
+
+    @property
+    def name(self):
+        return "K" + "".join(kind.value for kind in self.white) + "vK" + "".join(kind.value for kind in self.black)
+
+    def index(self, squares, turn):
+        best = None
+        for table in TRANSFORMS:
+            king = table[squares[0]]
+            if king in TRIANGLE:
+                key = (TRIANGLE[king], [table[sq] for sq in squares[1:]])
+                if best is None or key < best:
+                    best = key
+
+        index = (turn - 1) * len(TRIANGLE) + best[0]
+        for sq in best[1]:
+            index = index * BOARD_SIZE ** 2 + sq
+        return index
+
+    def decode(self, index):
+        squares = []
+        for _ in range(self.count - 1):
+            index, sq = divmod(index, BOARD_SIZE ** 2)
+            squares.append(sq)
+        turn, king = divmod(index, len(TRIANGLE))
+        return [TRIANGLE_SQUARES[king]] + squares[::-1], turn + 1
+
+    def probe(self, squares, turn):
+        # Returns (1, plies) if the side to move wins, (-1, plies) if it loses and (0, 0) for a draw.
+        value = self.values[self.index(squares, turn)]
+        if value == ILLEGAL:
+            return None
+        if value == 0:
+            return 0, 0
+        dtm = value - 1
+        return (1 if dtm % 2 else -1), dtm
+
+
+class Tablebases:
+    def __init__(self, directory=TABLEBASE_DIR):
+        self.directory = directory
+        self.tables = dict()
+
+    def path(self, table):
+        return os.path.join(self.directory, table.name + ".tb")
+
+    def load(self, white, black):
+        key = material(white, black)
+        if key not in self.tables:
+            table = Tablebase(*key)
+            path = self.path(table)
+            if os.path.exists(path):
+                with open(path, "rb") as file:
+                    table.values = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.tables[key] = table
+            else:
+                self.tables[key] = None
+        return self.tables[key]
+
+    def probe_material(self, white, black, squares, turn):
+        # squares lists the kings, then white's and black's pieces in the order of white and black.
+        if not white and not black:
+            return 0, 0
+
+        if swapped(white, black):
+            white, black = black, white
+            squares = [squares[1], squares[0]] + squares[2 + len(black):] + squares[2:2 + len(black)]
+            turn = 3 - turn
+
+        order_white = sorted(range(len(white)), key=lambda i: KINDS.index(white[i]))
+        order_black = sorted(range(len(black)), key=lambda i: KINDS.index(black[i]))
+        squares = squares[:2] + [squares[2 + i] for i in order_white] + [squares[2 + len(white) + i] for i in order_black]
+
+        table = self.load(white, black)
+        if table is None:
+            return None
+        return table.probe(squares, turn)
+
+    def probe(self, board):
+        kings = dict()
+        white, black = [], []
+        white_squares, black_squares = [], []
+
+        for sq, piece in enumerate(board.squares):
+            if piece is None:
+                continue
+            if len(white) + len(black) + len(kings) >= MAX_PIECES:
+                return None
+            if piece.kind == Kind.KING:
+                kings[piece.side] = sq
+            elif piece.kind not in TABLEBASE_KINDS:
+                return None
+            elif piece.side == 1:
+                white.append(piece.kind)
+                white_squares.append(sq)
+            else:
+                black.append(piece.kind)
+                black_squares.append(sq)
+
+        if len(kings) != 2:
+            return None
+        return self.probe_material(white, black, [kings[1], kings[2]] + white_squares + black_squares, board.turn)
+
+
+def place(board, pieces, squares):
+    for piece, sq in zip(pieces, squares):
+        piece.move(sq)
+        board.squares[sq] = piece
+
+
+def unplace(board, squares):
+    for sq in squares:
+        board.squares[sq] = None
+
+
+def attacked(board, pieces, king, side):
+    for piece in pieces:
+        if piece.side == side and board.squares[piece.square] is piece:
+            if king.square in piece.move_and_capture_squares(board, check_check=False, mode=CAPTURES)[1]:
+                return True
+    return False
+
+
+def legal_moves(board, pieces, turn):
+    # Yields (index of moving piece, to square, index of captured piece or None).
+    king = pieces[turn - 1]
+    other = 3 - turn
+    for i, piece in enumerate(pieces):
+        if piece.side != turn:
+            continue
+        moves, captures = piece.move_and_capture_squares(board, check_check=False, no_en_passant=True)
+        from_sq = piece.square
+        for to_sq in moves | captures:
+            captured = board.squares[to_sq]
+            board.squares[from_sq] = None
+            board.squares[to_sq] = piece
+            piece.move(to_sq)
+
+            legal = not attacked(board, pieces, king, other)
+
+            piece.move(from_sq)
+            board.squares[from_sq] = piece
+            board.squares[to_sq] = captured
+            if legal:
+                yield i, to_sq, None if captured is None else pieces.index(captured)
+
+
+def origins(board, piece):
+    # Squares the piece could have come from without capturing.
+    if piece.kind not in UNRETRACEABLE_KINDS:
+        return piece.move_and_capture_squares(board, check_check=False, mode=QUIETS)[0]
+
+    to_sq = piece.square
+    found = set()
+    board.squares[to_sq] = None
+    for sq in range(BOARD_SIZE ** 2):
+        if board.squares[sq] is None and sq != to_sq:
+            piece.move(sq)
+            board.squares[sq] = piece
+            if to_sq in piece.move_and_capture_squares(board, check_check=False, mode=QUIETS)[0]:
+                found.add(sq)
+            board.squares[sq] = None
+    piece.move(to_sq)
+    board.squares[to_sq] = piece
+    return found
+
+
+def predecessors(table, board, pieces, index):
+    squares, turn = table.decode(index)
+    mover = 3 - turn
+    found = set()
+
+    for image in {tuple(transform[sq] for sq in squares) for transform in TRANSFORMS}:
+        place(board, pieces, image)
+        for i, piece in enumerate(pieces):
+            if piece.side == mover:
+                for sq in origins(board, piece):
+                    previous = list(image)
+                    previous[i] = sq
+                    previous_index = table.index(previous, mover)
+                    if table.values[previous_index] != ILLEGAL:
+                        found.add(previous_index)
+        unplace(board, image)
+
+    return found
+
+
+def generate(white, black, tablebases=None, report=print):
+    if tablebases is None:
+        tablebases = Tablebases()
+    table = Tablebase(*material(white, black))
+    table.values = bytearray(table.size)
+    values = table.values
+    counters = array("H", bytes(2 * table.size))
+
+    # Captures leave the table, so the smaller tables have to exist first.
+    for i in range(2, table.count):
+        sub_white = [kind for j, kind in enumerate(table.white) if j != i - 2]
+        sub_black = [kind for j, kind in enumerate(table.black) if j != i - 2 - len(table.white)]
+        if (sub_white or sub_black) and tablebases.load(sub_white, sub_black) is None:
+            generate(sub_white, sub_black, tablebases, report)
+            tablebases.tables.pop(material(sub_white, sub_black))
+
+    report(f"Generating {table.name} with {table.size} positions")
+    board = Board()
+    pieces = [Piece(side, kind) for side, kind in zip(table.sides, table.kinds)]
+    levels = defaultdict(list)
+    events = defaultdict(list)  # Results of captures, applied when their level is processed.
+
+    def settle(index, dtm):
+        values[index] = dtm + 1
+        levels[dtm].append(index)
+
+    # INITIALIZE ALL POSITIONS WITH THEIR NUMBER OF MOVES
+    for index in range(table.size):
+        squares, turn = table.decode(index)
+        if len(set(squares)) < table.count or table.index(squares, turn) != index:
+            values[index] = ILLEGAL
+            continue
+
+        place(board, pieces, squares)
+        if attacked(board, pieces, pieces[2 - turn], turn):
+            values[index] = ILLEGAL
+            unplace(board, squares)
+            continue
+
+        successors = set()
+        losing_captures = 0
+        escape = False
+        has_moves = False
+        for i, to_sq, captured in legal_moves(board, pieces, turn):
+            has_moves = True
+            after = list(squares)
+            after[i] = to_sq
+            if captured is None:
+                successors.add(table.index(after, 3 - turn))
+                continue
+
+            remaining = [j for j in range(table.count) if j != captured]
+            result = tablebases.probe_material(
+                [table.kinds[j] for j in remaining if j >= 2 and table.sides[j] == 1],
+                [table.kinds[j] for j in remaining if j >= 2 and table.sides[j] == 2],
+                [after[j] for j in remaining], 3 - turn
+            )
+            if result is None or result[0] == 0:
+                escape = True
+            elif result[0] < 0:
+                escape = True
+                events[result[1] + 1].append((index, True))
+            else:
+                losing_captures += 1
+                events[result[1] + 1].append((index, False))
+
+        if not has_moves:
+            escape = True
+            if attacked(board, pieces, pieces[turn - 1], 3 - turn):
+                settle(index, 0)
+
+        counters[index] = ESCAPE if escape else len(successors) + losing_captures
+        unplace(board, squares)
+
+    # RETROGRADE ANALYSIS, ONE DISTANCE TO MATE AT A TIME
+    dtm = 0
+    while levels or events:
+        for index, win in events.pop(dtm, []):
+            if values[index] == 0:
+                if win:
+                    settle(index, dtm)
+                else:
+                    counters[index] -= 1
+                    if counters[index] == 0:
+                        settle(index, dtm)
+
+        positions = levels.pop(dtm, [])
+        if positions:
+            report(f"{table.name}: {len(positions)} positions with mate in {dtm} plies")
+        if dtm + 1 >= ILLEGAL - 1 and (positions or levels or events):
+            raise ValueError(f"{table.name} has mates longer than a byte can hold")
+
+        for index in positions:
+            for previous in predecessors(table, board, pieces, index):
+                if values[previous] != 0:
+                    continue
+                if dtm % 2 == 0:
+                    settle(previous, dtm + 1)
+                else:
+                    counters[previous] -= 1
+                    if counters[previous] == 0:
+                        settle(previous, dtm + 1)
+        dtm += 1
+
+    os.makedirs(tablebases.directory, exist_ok=True)
+    with open(tablebases.path(table), "wb") as file:
+        file.write(values)
+    return table
+
+
+def materials(kinds, max_pieces):
+    found = []
+    for count in range(1, max_pieces - 1):
+        for extras in itertools.combinations_with_replacement(sort_kinds(kinds), count):
+            for split in range(count + 1):
+                key = material(extras[:split], extras[split:])
+                if key not in found:
+                    found.append(key)
+    return found
+
+
+def main(args):
+    max_pieces = 3
+    if args[:1] == ["--pieces"]:
+        max_pieces = int(args[1])
+        args = args[2:]
+    if not 3 <= max_pieces <= MAX_PIECES:
+        raise SystemExit(f"Tables have 3 to {MAX_PIECES} pieces")
+
+    kinds = [Kind[name.upper()] for name in args]
+    for kind in kinds:
+        if kind not in TABLEBASE_KINDS:
+            raise SystemExit(f"There are no tables for the {kind.value}")
+
+    tablebases = Tablebases()
+    for white, black in materials(kinds, max_pieces):
+        if tablebases.load(white, black) is None:
+            generate(white, black, tablebases)
+            tablebases.tables.pop(material(white, black))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
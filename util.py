@@ -1,5 +1,6 @@
 BOARD_SIZE = 16
 TIME = 3600
+KEYFRAME_INTERVAL = 32  # Plies between full board states, in the move history and in game archives.
 
 
 def to_coords(square):
@@ -30,7 +31,14 @@ DIRS_ROOK = [DIR_NORTH, DIR_SOUTH, DIR_EAST, DIR_WEST]
 DIRS_BISHOP = [DIR_NORTHWEST, DIR_SOUTHWEST, DIR_NORTHEAST, DIR_SOUTHEAST]
 DIRS_QUEEN = DIRS_ROOK + DIRS_BISHOP
 
+# Generation modes of Piece.move_and_capture_squares and the board walks behind it.
+ALL_MOVES = 0
+CAPTURES = 1  # Only captures, moves are returned empty.
+QUIETS = 2  # Only moves to empty squares, captures are returned empty.
+ATTACKS = 3  # Occupied squares of either side the piece attacks, returned as captures.
+
 WORTHS = dict()
+TOOLTIPS = dict()  # Description lines of each kind, parsed once for every module.
 with open("resources/tooltips.txt") as file:
 	content = [line[:-1] for line in file.readlines()]
 	i = 0
@@ -40,6 +48,8 @@ with open("resources/tooltips.txt") as file:
 		WORTHS[key] = int(worth)
 
 		i += 2
+		start = i
 		while i < len(content) and content[i] != "":
 			i += 1
+		TOOLTIPS[key] = content[start:i]
 		i += 1